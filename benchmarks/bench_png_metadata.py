@@ -0,0 +1,53 @@
+#### Micro-benchmark: PIL decode/re-encode vs. chunk splicing for adding job metadata to ComfyUI PNG outputs
+# Usage: python benchmarks/bench_png_metadata.py [--repeat N]
+
+import argparse
+import functools
+import io
+import json
+import os
+import sys
+import time
+from PIL import Image, PngImagePlugin
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from distillery_output import OutputOptions, encode_image, splice_png_metadata # noqa: E402
+
+SIZES = [1024, 2048]
+TEMPLATE_INPUTS = {"NOISE_SEED": 1234, "INPUT_IMAGE": "", "MASK_IMAGE": "", "CONTROLNET_IMAGE": ""}
+
+def make_comfy_png(size): # Builds a PNG the way ComfyUI's SaveImage does: smooth gradient plus noise, 'prompt' and 'workflow' text chunks, compress_level=4
+    gradient = Image.linear_gradient('L').resize((size, size))
+    noise = Image.effect_noise((size, size), 48)
+    image = Image.merge('RGB', (gradient, noise, gradient.transpose(Image.Transpose.ROTATE_90)))
+    pnginfo = PngImagePlugin.PngInfo()
+    pnginfo.add_text('prompt', json.dumps({"3": {"class_type": "KSampler", "inputs": {"seed": 1234}}}))
+    pnginfo.add_text('workflow', json.dumps({"nodes": []}))
+    image_file = io.BytesIO()
+    image.save(image_file, format='PNG', pnginfo=pnginfo, compress_level=4)
+    return image_file.getvalue()
+
+def time_it(function, image_data, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(image_data, TEMPLATE_INPUTS)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    print(f"{'size':>10} {'png MB':>8} {'PIL re-encode ms':>18} {'splice ms':>10} {'speedup':>8}")
+    for size in SIZES:
+        image_data = make_comfy_png(size)
+        spliced = splice_png_metadata(image_data, TEMPLATE_INPUTS)
+        assert Image.open(io.BytesIO(spliced)).tobytes() == Image.open(io.BytesIO(image_data)).tobytes() # Pixels must be untouched
+        reencode_time = time_it(functools.partial(encode_image, options=OutputOptions()), image_data, args.repeat) # The output stage's fallback with default options: decode, then PNG at compress_level 6
+        splice_time = time_it(splice_png_metadata, image_data, args.repeat)
+        print(f"{f'{size}x{size}':>10} {len(image_data) / 1e6:>8.2f} {reencode_time * 1000:>18.1f} {splice_time * 1000:>10.2f} {reencode_time / splice_time:>7.0f}x")
+
+if __name__ == '__main__':
+    main()
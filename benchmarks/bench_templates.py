@@ -0,0 +1,77 @@
+#### Benchmark: deepcopy-per-seed vs. compiled templates with copy-on-write variants, on large synthetic workflows
+# Usage: python benchmarks/bench_templates.py [--nodes 300 1000] [--seeds 8] [--repeat 20]
+
+import argparse
+import copy
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from distillery_templates import CompiledTemplate, TemplateCache, structural_hash # noqa: E402
+
+def make_workflow(node_count): # Chains of LoRA -> encode -> sample -> decode -> save blocks until at least node_count nodes exist
+    workflow = {"1": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "model.safetensors"}}}
+    seed_paths = []
+    node_id = 2
+    while len(workflow) < node_count:
+        lora, positive, negative, latent, sampler, decode, save = (str(node_id + offset) for offset in range(7))
+        workflow[lora] = {"class_type": "LoraLoader", "inputs": {"lora_name": f"lora_{node_id}.safetensors", "strength_model": 0.8, "strength_clip": 0.8, "model": ["1", 0], "clip": ["1", 1]}}
+        workflow[positive] = {"class_type": "CLIPTextEncode", "inputs": {"text": "a photo of a dog " * 20, "clip": [lora, 1]}}
+        workflow[negative] = {"class_type": "CLIPTextEncode", "inputs": {"text": "blurry, low quality " * 10, "clip": [lora, 1]}}
+        workflow[latent] = {"class_type": "EmptyLatentImage", "inputs": {"width": 1024, "height": 1024, "batch_size": 1}}
+        workflow[sampler] = {"class_type": "KSampler", "inputs": {"seed": 1234, "steps": 30, "cfg": 7, "sampler_name": "euler", "scheduler": "karras", "denoise": 1.0, "model": [lora, 0], "positive": [positive, 0], "negative": [negative, 0], "latent_image": [latent, 0]}}
+        workflow[decode] = {"class_type": "VAEDecode", "inputs": {"samples": [sampler, 0], "vae": ["1", 2]}}
+        workflow[save] = {"class_type": "SaveImage", "inputs": {"filename_prefix": "bench", "images": [decode, 0]}}
+        seed_paths.append([sampler, "inputs", "seed"])
+        node_id += 7
+    return workflow, seed_paths
+
+def legacy_variants(workflow, seed_paths, seeds): # What worker_routine used to do: one deepcopy of the whole graph per seed
+    variants = []
+    for seed in range(seeds):
+        variant = copy.deepcopy(workflow)
+        for path in seed_paths:
+            target = variant
+            for key in path[:-1]:
+                target = target.get(key, {})
+            if path[-1] in target:
+                target[path[-1]] = seed
+        variants.append(variant)
+    return variants
+
+def compiled_variants(workflow, seed_paths, seeds):
+    template = TemplateCache().get(workflow, seed_paths)
+    return [template.with_seed(workflow, seed) for seed in range(seeds)]
+
+def median_time(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, nargs='+', default=[300, 1000])
+    parser.add_argument('--seeds', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    print(f"{'nodes':>6} {'deepcopy ms':>12} {'hash ms':>8} {'analysis ms':>12} {'cached+variants ms':>19} {'speedup':>8}")
+    for node_count in args.nodes:
+        workflow, seed_paths = make_workflow(node_count)
+        legacy = legacy_variants(workflow, seed_paths, args.seeds)
+        compiled = compiled_variants(workflow, seed_paths, args.seeds)
+        assert legacy == compiled # Same prompts either way
+        assert all(workflow[path[0]]["inputs"]["seed"] == 1234 for path in seed_paths) # The original graph is never modified
+        template_hash = structural_hash(workflow, seed_paths)
+        legacy_time = median_time(lambda: legacy_variants(workflow, seed_paths, args.seeds), args.repeat)
+        hash_time = median_time(lambda: structural_hash(workflow, seed_paths), args.repeat)
+        analysis_time = median_time(lambda: CompiledTemplate(workflow, seed_paths, template_hash), args.repeat)
+        compiled_time = median_time(lambda: compiled_variants(workflow, seed_paths, args.seeds), args.repeat)
+        print(f"{len(workflow):>6} {legacy_time * 1000:>12.2f} {hash_time * 1000:>8.2f} {analysis_time * 1000:>12.2f} {compiled_time * 1000:>19.2f} {legacy_time / compiled_time:>7.1f}x")
+
+if __name__ == '__main__':
+    main()
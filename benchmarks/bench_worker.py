@@ -0,0 +1,418 @@
+#### Benchmark: end-to-end worker overhead without a GPU or AWS - synthetic jobs through handler and worker_routine against fake ComfyUI servers, an in-memory S3 and a temporary network-storage folder
+# Usage: python benchmarks/bench_worker.py [--scenarios single batch latent_batch encoded concurrent img2img cold_models repeat restart] [--jobs 8] [--images 4] [--sampling-delay 0.5] [--save-baseline FILE] [--baseline FILE] [--tolerance 0.15] [--env KEY=VALUE ...]
+# Reports throughput, per-stage latency percentiles (from the job's own trace) and peak RSS per scenario; with --baseline, exits 1 if any of them regressed beyond the tolerance.
+
+import argparse
+import asyncio
+import contextlib
+import io
+import itertools
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from PIL import Image
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, REPO_ROOT)
+from fake_comfy import ImageFactory # noqa: E402
+from fake_s3 import FakeS3Client # noqa: E402
+
+BUCKET = 'distillery-bench'
+BASE_CHECKPOINT = 'bench_base.safetensors'
+SEED_PATHS = [["6", "inputs", "seed"]]
+SCENARIOS = ('single', 'batch', 'latent_batch', 'encoded', 'concurrent', 'img2img', 'cold_models', 'repeat', 'restart')
+CHECKS = ( # Metric, better direction, smallest absolute change worth reporting (seconds, images/s or MB)
+    ('images_per_second', 'higher', 0.05),
+    ('latency_p50', 'lower', 0.02),
+    ('latency_p95', 'lower', 0.02),
+    ('overhead_p50', 'lower', 0.02),
+    ('peak_rss_mb', 'lower', 16),
+    ('uploaded_mb', 'lower', 0.5),
+)
+seeds = itertools.count(1000) # Every job gets fresh seeds, so only the repeat scenario hits the result cache
+
+def configure_worker(args, root): # Points the worker at the fake backends and the temporary folders; must run before any distillery module is imported
+    folders = {name: os.path.join(root, name) for name in ('network_storage', 'models', 'comfy_input', 'comfy_output')}
+    for folder in folders.values():
+        os.makedirs(folder, exist_ok=True)
+    os.makedirs(os.path.join(folders['network_storage'], 'checkpoints'), exist_ok=True)
+    fake_comfy = os.path.join(BENCH_DIR, 'fake_comfy.py')
+    command_line = f"{sys.executable} {fake_comfy} --sampling-delay {args.sampling_delay} --steps {args.steps} --batch-cost {args.batch_cost} --output-size {args.output_size} --input-dir {folders['comfy_input']} --output-dir {folders['comfy_output']}" # Split on whitespace by the worker, so no path may contain spaces
+    os.environ.update({
+        'APP_NAME': 'distillery-bench',
+        'API_COMMAND_LINE': command_line,
+        'API_URL': '127.0.0.1',
+        'INITIAL_PORT': str(args.port),
+        'COMFY_BACKENDS': str(args.backends),
+        'COMFY_WARMUP': 'false',
+        'COMFY_SUPERVISE_INTERVAL': '0.5', # The restart scenario waits for the supervisor
+        'NETWORK_STORAGE': folders['network_storage'],
+        'MODELS_FOLDER': folders['models'],
+        'MODEL_CACHE_MIN_FREE_GB': '0',
+        'WORKER_TIMEOUT': str(args.timeout),
+        'WORKER_CONCURRENCY': str(args.concurrency),
+        'AWS_REGION_NAME': 'us-east-1',
+        'AWS_S3_BUCKET_NAME': BUCKET,
+        'RESULT_CACHE_PATH': os.path.join(root, 'result_cache.sqlite3'),
+        'METRICS_EMF': 'false',
+        'METRICS_PORT': '0',
+        'LOG_LEVEL': 'WARNING', # Without CloudWatch, print_log records go to the console
+    })
+    if args.local_outputs:
+        os.environ['COMFY_OUTPUT_FOLDER'] = folders['comfy_output']
+    for name in ('AWS_LOG_GROUP', 'TEST_PAYLOAD', 'RESULT_CACHE_S3_KEY'): # A developer shell may have the production values
+        os.environ.pop(name, None)
+    for item in args.env: # Worker tuning under test, e.g. MAX_QUEUED_PROMPTS=4
+        name, _, value = item.partition('=')
+        os.environ[name] = value
+    return folders
+
+def write_model(network_storage, model_name, size_mb): # A checkpoint of size_mb in the fake network storage; the worker copies it like a real one
+    with open(os.path.join(network_storage, 'checkpoints', model_name), 'wb') as file:
+        chunk = os.urandom(1024 * 1024) # Incompressible, so a filesystem cannot shortcut the copy
+        for _ in range(size_mb):
+            file.write(chunk)
+
+def make_workflow(checkpoint, width, height, seed, input_image=None): # Minimal txt2img graph, or img2img when input_image names an uploaded file
+    workflow = {
+        "1": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": checkpoint}},
+        "2": {"class_type": "CLIPTextEncode", "inputs": {"text": "a photo of a dog", "clip": ["1", 1]}},
+        "3": {"class_type": "CLIPTextEncode", "inputs": {"text": "blurry, low quality", "clip": ["1", 1]}},
+        "6": {"class_type": "KSampler", "inputs": {"seed": seed, "steps": 20, "cfg": 7, "sampler_name": "euler", "scheduler": "karras", "denoise": 1.0, "model": ["1", 0], "positive": ["2", 0], "negative": ["3", 0], "latent_image": ["4", 0]}},
+        "7": {"class_type": "VAEDecode", "inputs": {"samples": ["6", 0], "vae": ["1", 2]}},
+        "8": {"class_type": "SaveImage", "inputs": {"filename_prefix": "bench", "images": ["7", 0]}},
+    }
+    if input_image is None:
+        workflow["4"] = {"class_type": "EmptyLatentImage", "inputs": {"width": width, "height": height, "batch_size": 1}}
+    else:
+        workflow["4"] = {"class_type": "VAEEncode", "inputs": {"pixels": ["5", 0], "vae": ["1", 2]}}
+        workflow["5"] = {"class_type": "LoadImage", "inputs": {"image": input_image}}
+        workflow["6"]["inputs"]["denoise"] = 0.6
+    return workflow
+
+def make_event(args, images_per_batch=1, checkpoint=BASE_CHECKPOINT, input_key=None, seed=None, latent_batch=False, output_options=None):
+    seed = next(seeds) * 100 if seed is None else seed # Spaced out, since a batch uses seed, seed + 1, ...
+    workflow = make_workflow(checkpoint, args.width, args.width, seed, os.path.basename(input_key) if input_key else None)
+    template_inputs = {"NOISE_SEED": seed, "NOISE_SEED_TEMPLATE_PATHS": SEED_PATHS, "INPUT_IMAGE": input_key or "", "MASK_IMAGE": "", "CONTROLNET_IMAGE": "", "SD15_CHECKPOINT": checkpoint}
+    event = {"input": {"comfy_api": workflow, "template_inputs": template_inputs, "images_per_batch": images_per_batch, "latent_batch": latent_batch, "return_stats": True}}
+    if output_options is not None:
+        event["input"]["output_options"] = output_options
+    return event
+
+def check_encoded_outputs(events, timed, s3, read_image_metadata, thumbnail_size): # Every original must carry the job's metadata, and every thumbnail a reference to its original with the same seed and fit thumbnail_size; returns the problems found
+    problems = []
+    for event, (result, _) in zip(events, timed):
+        if not isinstance(result, dict):
+            continue
+        seed = event['input']['template_inputs']['NOISE_SEED']
+        for s3_key, thumbnail_key in zip(result['s3_keys'], result.get('thumbnail_keys') or [None] * len(result['s3_keys'])):
+            metadata = read_image_metadata(s3.get(BUCKET, s3_key))
+            if metadata is None or metadata['template_inputs']['NOISE_SEED'] < seed or '6' not in metadata['comfy_api']:
+                problems.append(f"{s3_key}: metadata missing or wrong: {str(metadata)[:200]}")
+                continue
+            if thumbnail_key is not None:
+                thumbnail_metadata = read_image_metadata(s3.get(BUCKET, thumbnail_key))
+                if thumbnail_metadata is None or thumbnail_metadata.get('original') != s3_key or thumbnail_metadata['template_inputs'].get('NOISE_SEED') != metadata['template_inputs']['NOISE_SEED']:
+                    problems.append(f"{thumbnail_key}: reference to {s3_key} missing or wrong: {str(thumbnail_metadata)[:200]}")
+            if thumbnail_size and (thumbnail_key is None or max(Image.open(io.BytesIO(s3.get(BUCKET, thumbnail_key))).size) > thumbnail_size):
+                problems.append(f"{s3_key}: thumbnail {thumbnail_key} missing or larger than {thumbnail_size}")
+    return problems
+
+def check_latent_batches(events, timed, s3, read_text_chunk, batch_max): # Every image of a batched job must record its batch's seed and BATCH_SIZE, as sampled, and its own BATCH_INDEX; returns the problems found
+    problems = []
+    for event, (result, _) in zip(events, timed):
+        if not isinstance(result, dict):
+            continue
+        seed = event['input']['template_inputs']['NOISE_SEED']
+        images_per_batch = event['input']['images_per_batch']
+        batch_limit = batch_max or images_per_batch
+        recorded = []
+        for s3_key in result['s3_keys']:
+            metadata = json.loads(read_text_chunk(s3.get(BUCKET, s3_key), 'prompt'))
+            template_inputs = metadata['template_inputs']
+            sampled = (metadata['comfy_api']['6']['inputs']['seed'], metadata['comfy_api']['4']['inputs']['batch_size'])
+            if (template_inputs['NOISE_SEED'], template_inputs.get('BATCH_SIZE')) != sampled:
+                problems.append(f"{s3_key}: records seed and batch size {(template_inputs['NOISE_SEED'], template_inputs.get('BATCH_SIZE'))} but the graph ran {sampled}")
+            recorded.append((template_inputs['NOISE_SEED'], template_inputs.get('BATCH_INDEX')))
+        expected = [(seed + i // batch_limit, i % batch_limit) for i in range(images_per_batch)]
+        if recorded != expected:
+            problems.append(f"seed {seed}: outputs record (seed, BATCH_INDEX) {recorded}, expected {expected}")
+    return problems
+
+def start_outage(connector, restart_delay): # Leaves backend 0 running but unhealthy, as a failed startup or warm-up does, and slows its restart so the scenario's jobs run during the outage; returns what check_restart needs
+    os.environ['FAKE_COMFY_STARTUP_DELAY'] = str(restart_delay) # Inherited by the restarted process only
+    victim = connector.backends[0]
+    routed = []
+    acquire = connector.acquire_backend
+    def recording_acquire(models=()): # Records which backend, and which process of it, each job was routed to
+        backend = acquire(models)
+        routed.append((backend.index, backend._process.pid))
+        return backend
+    connector.acquire_backend = recording_acquire
+    outage = {"victim": victim, "pid": victim._process.pid, "routed": routed}
+    victim.healthy = False
+    return outage
+
+def check_restart(worker, connector, outage, args): # The supervisor must replace the unhealthy process, no job may reach it meanwhile, and the new process must serve jobs again; returns the problems found
+    problems = []
+    victim = outage['victim']
+    deadline = time.time() + args.restart_delay + 30
+    while not (victim.healthy and victim._process.pid != outage['pid']) and time.time() < deadline:
+        time.sleep(0.1)
+    os.environ.pop('FAKE_COMFY_STARTUP_DELAY', None)
+    if not victim.healthy or victim._process.pid == outage['pid']:
+        problems.append(f"backend on port {victim.urlport} was not restarted (PID {outage['pid']} -> {victim._process.pid}, healthy={victim.healthy})")
+    stale = [index for index, pid in outage['routed'] if index == victim.index and pid == outage['pid']]
+    if stale:
+        problems.append(f"{len(stale)} jobs were routed to the unhealthy backend on port {victim.urlport}")
+    if not problems:
+        del outage['routed'][:]
+        result = worker.worker_routine(make_event(args)) # With every backend idle, the lowest index wins the tie
+        if not isinstance(result, dict) or outage['routed'] != [(victim.index, victim._process.pid)]:
+            problems.append(f"restarted backend on port {victim.urlport} did not serve the next job: routed to {outage['routed']}, result {str(result)[:200]}")
+    del connector.acquire_backend # Back to the class method
+    return problems
+
+def build_scenario(name, args, folders, s3): # Returns (events, runner) for one scenario; runner is 'worker_routine' (one job at a time) or 'handler' (concurrent, as RunPod drives it)
+    if name == 'single':
+        return [make_event(args) for _ in range(args.jobs)], 'worker_routine'
+    if name == 'batch':
+        return [make_event(args, args.images) for _ in range(args.jobs)], 'worker_routine'
+    if name == 'latent_batch':
+        return [make_event(args, args.images, latent_batch=True) for _ in range(args.jobs)], 'worker_routine'
+    if name == 'encoded':
+        return [make_event(args, args.images, output_options=json.loads(args.output_options)) for _ in range(args.jobs)], 'worker_routine'
+    if name == 'concurrent':
+        return [make_event(args, args.images) for _ in range(args.jobs)], 'handler'
+    if name == 'img2img':
+        images = ImageFactory(0.5)
+        events = []
+        for index in range(args.jobs): # A new input per job, so every job downloads and uploads one; the keys share a file name, as inputs of different users can
+            input_key = f"inputs/{next(seeds)}/bench_input.png"
+            s3.put_object(Bucket=BUCKET, Key=input_key, Body=images.png(args.width, args.width, {"job": str(index)}))
+            events.append(make_event(args, input_key=input_key))
+        return events, 'worker_routine'
+    if name == 'cold_models':
+        events = []
+        for _ in range(args.jobs): # A checkpoint no earlier job used, so every job copies one from network storage
+            model_name = f"bench_cold_{next(seeds)}.safetensors"
+            write_model(folders['network_storage'], model_name, args.model_mb)
+            events.append(make_event(args, checkpoint=model_name))
+        return events, 'worker_routine'
+    if name == 'repeat':
+        seed = next(seeds) * 100
+        return [make_event(args, args.images, seed=seed) for _ in range(args.jobs)], 'worker_routine' # The first job generates, the others are answered by the result cache
+    if name == 'restart':
+        return [make_event(args, args.images) for _ in range(args.jobs)], 'handler' # Run while backend 0 restarts; see start_outage
+    raise ValueError(f"Unknown scenario {name}; expected one of {SCENARIOS}")
+
+def run_jobs(worker, events, runner, concurrency): # Returns [(result, seconds)] in event order
+    if runner == 'worker_routine':
+        timed = []
+        for event in events:
+            start = time.time()
+            result = worker.worker_routine(event)
+            timed.append((result, time.time() - start))
+        return timed
+    async def run_all():
+        slots = asyncio.Semaphore(concurrency) # RunPod hands the worker at most concurrency_modifier() jobs at once
+        async def run(event):
+            async with slots:
+                start = time.time()
+                result = await worker.handler(event)
+                return result, time.time() - start
+        return await asyncio.gather(*(run(event) for event in events))
+    return asyncio.run(run_all())
+
+def reset_peak_rss(): # Linux lets a process reset its own high-water mark, so each scenario reports its own peak
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
+
+def peak_rss_mb():
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024 # Bytes on macOS, kilobytes elsewhere
+
+def summarize(timed, wall_seconds, peak_rss, quantile): # Throughput, latency and stage percentiles of one scenario
+    finished = [(result, seconds) for result, seconds in timed if isinstance(result, dict)]
+    latencies = sorted(seconds for _, seconds in finished)
+    overheads = sorted(result['stages']['total'] - result['stages'].get('sampling', 0) for result, _ in finished) # Time the job spent outside its own sampling; queue waits overlap earlier seeds' sampling, so they are not subtracted
+    images = sum(len(result['s3_keys']) for result, _ in finished)
+    stages = {}
+    for result, _ in finished:
+        for stage, seconds in result['stages'].items():
+            stages.setdefault(stage, []).append(seconds)
+    summary = {
+        "jobs": len(timed),
+        "failed": len(timed) - len(finished),
+        "images": images,
+        "wall_seconds": round(wall_seconds, 3),
+        "images_per_second": round(images / wall_seconds, 3) if wall_seconds else 0,
+        "latency_p50": round(quantile(latencies, 0.5), 4) if latencies else None,
+        "latency_p95": round(quantile(latencies, 0.95), 4) if latencies else None,
+        "overhead_p50": round(quantile(overheads, 0.5), 4) if overheads else None,
+        "peak_rss_mb": round(peak_rss, 1),
+        "result_cache_hits": sum((result.get('result_cache') or {}).get('hits', 0) for result, _ in finished),
+        "stages": {stage: {"p50": round(quantile(sorted(values), 0.5), 4), "p95": round(quantile(sorted(values), 0.95), 4)} for stage, values in stages.items()},
+    }
+    return summary
+
+def print_report(results, peak_resettable, out):
+    print(f"\n{'scenario':<12} {'jobs':>5} {'fail':>5} {'images':>6} {'wall_s':>8} {'img/s':>7} {'lat_p50':>8} {'lat_p95':>8} {'ovh_p50':>8} {'rss_mb':>8} {'up_mb':>8}", file=out)
+    for name, summary in results.items():
+        print(f"{name:<12} {summary['jobs']:>5} {summary['failed']:>5} {summary['images']:>6} {summary['wall_seconds']:>8.2f} {summary['images_per_second']:>7.2f} {summary['latency_p50'] or 0:>8.3f} {summary['latency_p95'] or 0:>8.3f} {summary['overhead_p50'] or 0:>8.3f} {summary['peak_rss_mb']:>8.1f} {summary['uploaded_mb']:>8.2f}", file=out)
+    if not peak_resettable:
+        print("(peak RSS could not be reset between scenarios; each value is the process peak so far)", file=out)
+    for name, summary in results.items():
+        print(f"\n{name} stages (seconds per job, p50 / p95):", file=out)
+        for stage, values in summary['stages'].items():
+            print(f"  {stage:<16} {values['p50']:>9.4f} {values['p95']:>9.4f}", file=out)
+
+def compare(results, baseline, tolerance, out): # Prints every change beyond the tolerance and returns the regressions
+    regressions = []
+    print(f"\nComparison with baseline (tolerance {tolerance:.0%}):", file=out)
+    for name, summary in results.items():
+        previous = baseline['scenarios'].get(name)
+        if previous is None:
+            print(f"  {name}: not in the baseline", file=out)
+            continue
+        checks = [(metric, summary.get(metric), previous.get(metric), better, min_delta) for metric, better, min_delta in CHECKS]
+        checks += [(f"stage {stage} p50", values['p50'], previous['stages'][stage]['p50'], 'lower', 0.02) for stage, values in summary['stages'].items() if stage in previous.get('stages', {})]
+        for metric, current, old, better, min_delta in checks:
+            if current is None or old is None or abs(current - old) < min_delta:
+                continue
+            change = (current - old) / old if old else float('inf')
+            worse = change < -tolerance if better == 'higher' else change > tolerance
+            better_by = change > tolerance if better == 'higher' else change < -tolerance
+            if worse or better_by:
+                print(f"  {'REGRESSION' if worse else 'improved  '} {name} {metric}: {old} -> {current} ({change:+.1%})", file=out)
+            if worse:
+                regressions.append((name, metric, old, current))
+    if not regressions:
+        print("  no regressions", file=out)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS), choices=SCENARIOS)
+    parser.add_argument('--jobs', type=int, default=8, help='Jobs per scenario')
+    parser.add_argument('--images', type=int, default=4, help='images_per_batch of the batch, concurrent and repeat scenarios')
+    parser.add_argument('--width', type=int, default=1024, help='Latent width and height of the synthetic workflow')
+    parser.add_argument('--sampling-delay', type=float, default=0.5, help='Seconds the fake ComfyUI spends in each sampler node')
+    parser.add_argument('--steps', type=int, default=20, help='Progress events per sampler node')
+    parser.add_argument('--batch-cost', type=float, default=0.35, help='Extra sampling time of each additional image in a latent batch')
+    parser.add_argument('--output-size', type=int, default=0, help='Output width and height; 0 follows the latent size')
+    parser.add_argument('--backends', type=int, default=2, help='COMFY_BACKENDS; the restart scenario needs at least 2')
+    parser.add_argument('--restart-delay', type=float, default=2.0, help='Seconds a fake backend takes to come back in the restart scenario')
+    parser.add_argument('--concurrency', type=int, default=2, help='WORKER_CONCURRENCY, and jobs run at once by the concurrent scenario')
+    parser.add_argument('--model-mb', type=int, default=64, help='Size of each checkpoint in the fake network storage')
+    parser.add_argument('--s3-latency', type=float, default=0.02, help='Seconds added to every S3 call')
+    parser.add_argument('--s3-bandwidth', type=float, default=100, help='S3 transfer rate in MB/s; 0 is unlimited')
+    parser.add_argument('--output-options', default='{"format": "webp", "quality": 85, "thumbnail_size": 256}', help='output_options of the encoded scenario, as JSON')
+    parser.add_argument('--local-outputs', action='store_true', help='Set COMFY_OUTPUT_FOLDER so outputs are read from disk instead of /view')
+    parser.add_argument('--port', type=int, default=18188, help='INITIAL_PORT of the fake backends')
+    parser.add_argument('--timeout', type=int, default=600, help='WORKER_TIMEOUT')
+    parser.add_argument('--env', nargs='*', default=[], help='Extra worker settings as KEY=VALUE, applied last')
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    parser.add_argument('--save-baseline', help='Write the results and settings as a baseline to this file')
+    parser.add_argument('--baseline', help='Compare with a baseline written by --save-baseline; exits 1 on regression')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='Relative change tolerated before a metric counts as a regression')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary folders')
+    parser.add_argument('--verbose', action='store_true', help='Show the worker output')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline: # Read first, so a bad path fails before the run
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    root = tempfile.mkdtemp(prefix='distillery-bench-')
+    folders = configure_worker(args, root)
+    write_model(folders['network_storage'], BASE_CHECKPOINT, args.model_mb)
+    out = sys.stdout
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, 'w')) # The worker prints every step
+    try:
+        with quiet:
+            import distillery_worker as worker
+            from distillery_aws import AWSConnector
+            from distillery_comfy import ComfyConnector
+            from distillery_metrics import quantile
+            from distillery_png import read_text_chunk
+            from distillery_output import read_image_metadata
+            s3 = FakeS3Client(latency=args.s3_latency, bandwidth_mbps=args.s3_bandwidth)
+            AWSConnector().reset_s3_client(s3)
+            start = time.time()
+            ComfyConnector() # Starts the fake backends; counted apart from the scenarios
+            startup_seconds = time.time() - start
+        print(f"Fake ComfyUI backends up in {startup_seconds:.2f} s ({args.backends} backend(s), work dir {root})", file=out)
+        results = {}
+        peak_resettable = True
+        for name in args.scenarios:
+            events, runner = build_scenario(name, args, folders, s3)
+            if name == 'restart' and args.backends < 2:
+                print(f"{name}: skipped, needs --backends 2 or more so jobs can be routed away", file=out)
+                continue
+            peak_resettable = reset_peak_rss() and peak_resettable
+            with quiet:
+                outage = start_outage(ComfyConnector(), args.restart_delay) if name == 'restart' else None
+                uploaded_bytes = s3.total_bytes(BUCKET)
+                start = time.time()
+                timed = run_jobs(worker, events, runner, args.concurrency)
+                wall_seconds = time.time() - start
+                uploaded_bytes = s3.total_bytes(BUCKET) - uploaded_bytes
+            results[name] = summarize(timed, wall_seconds, peak_rss_mb(), quantile)
+            results[name]['uploaded_mb'] = round(uploaded_bytes / (1024 * 1024), 2)
+            problems = []
+            if name == 'latent_batch':
+                problems = check_latent_batches(events, timed, s3, read_text_chunk, worker.LATENT_BATCH_MAX)
+            elif name == 'encoded':
+                problems = check_encoded_outputs(events, timed, s3, read_image_metadata, json.loads(args.output_options).get('thumbnail_size', 0))
+            elif name == 'restart':
+                with quiet:
+                    problems = check_restart(worker, ComfyConnector(), outage, args)
+            if problems:
+                results[name]['check_errors'] = len(problems)
+            for problem in problems:
+                print(f"{name}: {problem}", file=out)
+            print(f"{name}: {results[name]['images']} images in {wall_seconds:.2f} s, {results[name]['failed']} failed", file=out)
+        print_report(results, peak_resettable, out)
+        report = {"settings": {key: value for key, value in vars(args).items() if key not in ('output', 'save_baseline', 'baseline', 'keep', 'verbose')}, "startup_seconds": round(startup_seconds, 3), "s3_calls": s3.calls, "scenarios": results}
+        if args.output:
+            with open(args.output, 'w') as file:
+                json.dump(report, file, indent=2)
+        if args.save_baseline:
+            with open(args.save_baseline, 'w') as file:
+                json.dump(report, file, indent=2)
+            print(f"\nBaseline saved to {args.save_baseline}", file=out)
+        regressions = []
+        if baseline is not None:
+            changed = {key: (value, report['settings'][key]) for key, value in baseline.get('settings', {}).items() if report['settings'].get(key) != value}
+            if changed:
+                print(f"\nWarning: settings differ from the baseline: {changed}", file=out)
+            regressions = compare(results, baseline, args.tolerance, out)
+    finally:
+        if 'distillery_comfy' in sys.modules:
+            for backend in getattr(sys.modules['distillery_comfy'].ComfyConnector._instance, 'backends', []): # The supervisor would restart them, but it dies with this process
+                backend.ws = None # Lets the listener exit quietly instead of reconnecting
+                if backend.is_process_alive():
+                    backend._process.kill()
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+    sys.exit(1 if regressions or any(summary['failed'] or summary.get('check_errors') for summary in results.values()) else 0)
+
+if __name__ == '__main__':
+    main()
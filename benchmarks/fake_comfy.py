@@ -0,0 +1,402 @@
+#### Fake ComfyUI server for the worker benchmarks - the REST and /ws surface the worker uses, with simulated sampling time and real PNG outputs
+# Usage: python benchmarks/fake_comfy.py --port 8188 [--sampling-delay 0.5] [--steps 20] [--output-size 1024] [--output-dir DIR] [--input-dir DIR]
+# Started by the worker through API_COMMAND_LINE; unknown ComfyUI flags (e.g. --cuda-device 0) are accepted and ignored.
+
+import argparse
+import base64
+import email.parser
+import email.policy
+import hashlib
+import json
+import os
+import struct
+import threading
+import time
+import uuid
+import zlib
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11' # RFC 6455 handshake constant
+SAMPLER_CLASSES = {"KSampler", "KSamplerAdvanced", "SamplerCustom", "SamplerCustomAdvanced"} # Nodes that take --sampling-delay and send progress events
+LATENT_CLASSES = {"EmptyLatentImage", "EmptySD3LatentImage"} # Nodes whose batch_size sets how many images each saver writes
+SAVE_CLASSES = {"SaveImage"}
+PREVIEW_CLASSES = {"PreviewImage"}
+LOAD_IMAGE_CLASSES = {"LoadImage", "LoadImageMask"} # Nodes whose 'image' must name a file in the input folder
+
+def png_chunk(chunk_type, body):
+    return struct.pack('>I', len(body)) + chunk_type + body + struct.pack('>I', zlib.crc32(chunk_type + body) & 0xffffffff)
+
+class ImageFactory: # Builds PNGs of a given size once and reuses their pixel data; only the text chunks differ between outputs
+    def __init__(self, entropy):
+        self.entropy = entropy # Share of each row filled with noise; the rest is flat, so the PNG compresses like a real image
+        self.idat = {}
+        self.lock = threading.Lock()
+
+    def pixel_chunk(self, width, height):
+        with self.lock:
+            if (width, height) not in self.idat:
+                noisy = int(width * 3 * self.entropy)
+                rows = b''.join(b'\x00' + os.urandom(noisy) + bytes(width * 3 - noisy) for _ in range(height)) # Filter byte 0 + RGB row
+                self.idat[(width, height)] = png_chunk(b'IDAT', zlib.compress(rows, 1))
+            return self.idat[(width, height)]
+
+    def png(self, width, height, text): # ComfyUI's SaveImage stores the prompt as a 'prompt' tEXt chunk ahead of the image data
+        header = png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+        chunks = b''.join(png_chunk(b'tEXt', key.encode('latin-1') + b'\x00' + value.encode('latin-1', 'replace')) for key, value in text.items())
+        return b'\x89PNG\r\n\x1a\n' + header + chunks + self.pixel_chunk(width, height) + png_chunk(b'IEND', b'')
+
+class WebSocketClient: # One /ws connection; frames are sent by the executor thread and by request threads
+    def __init__(self, client_id, wfile):
+        self.client_id = client_id
+        self.wfile = wfile
+        self.lock = threading.Lock()
+        self.open = True
+
+    def send(self, opcode, payload):
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('>BB', 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack('>BBH', 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack('>BBQ', 0x80 | opcode, 127, length)
+        with self.lock:
+            if not self.open:
+                return
+            try:
+                self.wfile.write(header + payload)
+                self.wfile.flush()
+            except OSError:
+                self.open = False
+
+    def send_json(self, message):
+        self.send(0x1, json.dumps(message).encode('utf-8'))
+
+class FakeComfy: # Queue, history and executor of the fake server; one prompt runs at a time, like ComfyUI
+    def __init__(self, args):
+        self.args = args
+        self.queue = deque() # (number, prompt_id, prompt, client_id) waiting to run
+        self.history = {} # Prompt id -> /history entry
+        self.clients = {} # Client id -> WebSocketClient
+        self.running = None # (number, prompt_id, prompt, client_id) of the prompt being executed
+        self.interrupted = False
+        self.number = 0
+        self.counter = 0 # Output file counter, as in ComfyUI's file names
+        self.condition = threading.Condition()
+        self.images = ImageFactory(args.output_entropy)
+        os.makedirs(args.output_dir, exist_ok=True)
+        os.makedirs(args.input_dir, exist_ok=True)
+        threading.Thread(target=self.execute_loop, name='fake-comfy-executor', daemon=True).start()
+
+    def queue_remaining(self):
+        return len(self.queue) + (1 if self.running is not None else 0)
+
+    def send(self, client_id, message_type, data):
+        client = self.clients.get(client_id)
+        if client is not None:
+            client.send_json({"type": message_type, "data": data})
+
+    def broadcast_status(self):
+        status = {"status": {"exec_info": {"queue_remaining": self.queue_remaining()}}}
+        for client in list(self.clients.values()):
+            client.send_json({"type": "status", "data": status})
+
+    def enqueue(self, prompt, client_id):
+        with self.condition:
+            self.number += 1
+            prompt_id = str(uuid.uuid4())
+            self.queue.append((self.number, prompt_id, prompt, client_id))
+            self.condition.notify()
+            number = self.number
+        self.broadcast_status()
+        return prompt_id, number
+
+    def delete(self, prompt_ids):
+        with self.condition:
+            self.queue = deque(item for item in self.queue if item[1] not in prompt_ids)
+
+    def interrupt(self, prompt_id=None):
+        with self.condition:
+            if self.running is not None and (prompt_id is None or self.running[1] == prompt_id):
+                self.interrupted = True
+
+    def execute_loop(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                self.running = self.queue.popleft()
+                self.interrupted = False
+            try:
+                self.execute(*self.running)
+            except Exception as e:
+                print(f"Fake ComfyUI failed on prompt {self.running[1]}: {e}")
+            with self.condition:
+                self.running = None
+            self.broadcast_status()
+
+    def batch_size(self, prompt): # The largest batch_size of any latent node; a real graph routes it to the saver through the sampler and decoder
+        sizes = [node.get("inputs", {}).get("batch_size", 1) for node in prompt.values() if node.get("class_type") in LATENT_CLASSES]
+        return max([size for size in sizes if isinstance(size, int)] or [1])
+
+    def image_size(self, prompt):
+        if self.args.output_size:
+            return self.args.output_size, self.args.output_size
+        for node in prompt.values():
+            if node.get("class_type") in LATENT_CLASSES:
+                inputs = node.get("inputs", {})
+                if isinstance(inputs.get("width"), int) and isinstance(inputs.get("height"), int):
+                    return inputs["width"], inputs["height"]
+        return 512, 512
+
+    def execute(self, number, prompt_id, prompt, client_id):
+        started = time.time()
+        self.send(client_id, 'execution_start', {"prompt_id": prompt_id, "timestamp": int(started * 1000)})
+        self.send(client_id, 'execution_cached', {"nodes": [], "prompt_id": prompt_id, "timestamp": int(started * 1000)})
+        batch_size = self.batch_size(prompt)
+        width, height = self.image_size(prompt)
+        outputs = {}
+        for node_id in sorted(prompt, key=lambda key: (0, int(key), '') if str(key).isdigit() else (1, 0, str(key))):
+            node = prompt[node_id]
+            class_type = node.get("class_type")
+            self.send(client_id, 'executing', {"node": node_id, "display_node": node_id, "prompt_id": prompt_id})
+            if class_type in SAMPLER_CLASSES:
+                step_delay = self.args.sampling_delay * (1 + (batch_size - 1) * self.args.batch_cost) / self.args.steps # A batch shares one pass over the model, so it costs less than batch_size prompts
+                for step in range(1, self.args.steps + 1):
+                    time.sleep(step_delay)
+                    if self.interrupted:
+                        self.send(client_id, 'execution_interrupted', {"prompt_id": prompt_id, "node_id": node_id, "node_type": class_type, "executed": list(outputs)})
+                        time.sleep(self.args.history_delay)
+                        self.record(prompt_id, number, prompt, client_id, outputs, 'error', [["execution_interrupted", {"prompt_id": prompt_id}]])
+                        self.send(client_id, 'executing', {"node": None, "prompt_id": prompt_id})
+                        return
+                    self.send(client_id, 'progress', {"value": step, "max": self.args.steps, "prompt_id": prompt_id, "node": node_id})
+            elif class_type in SAVE_CLASSES or class_type in PREVIEW_CLASSES:
+                folder_type = 'output' if class_type in SAVE_CLASSES else 'temp'
+                prefix = node.get("inputs", {}).get("filename_prefix", "ComfyUI") if folder_type == 'output' else 'ComfyUI_temp'
+                images = []
+                for batch_index in range(batch_size):
+                    self.counter += 1
+                    filename = f"{prefix}_{self.args.port}_{self.counter:05}_.png" # Backends of one worker share the output folder
+                    text = {"prompt": json.dumps(prompt), "batch_index": str(batch_index)}
+                    folder = self.args.output_dir if folder_type == 'output' else os.path.join(self.args.output_dir, 'temp')
+                    os.makedirs(folder, exist_ok=True)
+                    with open(os.path.join(folder, filename), 'wb') as file:
+                        file.write(self.images.png(width, height, text))
+                    images.append({"filename": filename, "subfolder": "temp" if folder_type == 'temp' else "", "type": folder_type})
+                outputs[node_id] = {"images": images}
+                self.send(client_id, 'executed', {"node": node_id, "display_node": node_id, "output": {"images": images}, "prompt_id": prompt_id})
+        self.send(client_id, 'execution_success', {"prompt_id": prompt_id, "timestamp": int(time.time() * 1000)}) # Sent from inside execute(), like ComfyUI, before task_done() writes the history entry
+        time.sleep(self.args.history_delay)
+        self.record(prompt_id, number, prompt, client_id, outputs, 'success', [["execution_success", {"prompt_id": prompt_id}]])
+        self.send(client_id, 'executing', {"node": None, "prompt_id": prompt_id}) # Only after the history entry exists
+
+    def record(self, prompt_id, number, prompt, client_id, outputs, status_str, messages):
+        with self.condition:
+            self.history[prompt_id] = {
+                "prompt": [number, prompt_id, prompt, {"client_id": client_id}, [node_id for node_id in outputs]],
+                "outputs": outputs,
+                "status": {"status_str": status_str, "completed": status_str == 'success', "messages": messages}
+            }
+
+class FakeComfyHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Keep-alive, as the worker's pooled session expects
+    server_version = 'FakeComfy/1.0'
+
+    @property
+    def comfy(self):
+        return self.server.comfy
+
+    def log_message(self, format, *args): # One line per request would drown the benchmark output
+        pass
+
+    def send_json(self, value, status=200):
+        body = json.dumps(value).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def read_json(self):
+        body = self.read_body()
+        return json.loads(body) if body else {}
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if url.path == '/ws':
+            self.serve_websocket(query.get('clientId') or uuid.uuid4().hex)
+        elif url.path == '/system_stats':
+            self.send_json({"system": {"os": os.name, "python_version": "fake", "comfyui_version": "fake"}, "devices": []})
+        elif url.path == '/queue':
+            with self.comfy.condition:
+                running = [list(self.comfy.running)] if self.comfy.running is not None else []
+                pending = [list(item) for item in self.comfy.queue]
+            self.send_json({"queue_running": running, "queue_pending": pending})
+        elif url.path == '/history':
+            with self.comfy.condition:
+                self.send_json(dict(self.comfy.history))
+        elif url.path.startswith('/history/'):
+            prompt_id = url.path[len('/history/'):]
+            with self.comfy.condition:
+                entry = self.comfy.history.get(prompt_id)
+            self.send_json({prompt_id: entry} if entry is not None else {})
+        elif url.path == '/view':
+            self.serve_file(query.get('filename', ''), query.get('subfolder', ''), query.get('type', 'output'))
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path == '/prompt':
+            request = self.read_json()
+            prompt = request.get('prompt')
+            if not isinstance(prompt, dict) or not prompt:
+                self.send_json({"error": {"type": "invalid_prompt", "message": "Prompt has no nodes"}, "node_errors": {}}, status=400)
+                return
+            if not any(node.get("class_type") in SAVE_CLASSES | PREVIEW_CLASSES for node in prompt.values()):
+                self.send_json({"error": {"type": "prompt_no_outputs", "message": "Prompt has no outputs"}, "node_errors": {}}, status=400)
+                return
+            missing = {node_id: node["inputs"]["image"] for node_id, node in prompt.items() if node.get("class_type") in LOAD_IMAGE_CLASSES and not os.path.isfile(os.path.join(self.comfy.args.input_dir, str(node.get("inputs", {}).get("image"))))}
+            if missing: # ComfyUI validates LoadImage against its input folder before queueing
+                self.send_json({"error": {"type": "prompt_outputs_failed_validation", "message": f"Invalid image file: {missing}"}, "node_errors": {}}, status=400)
+                return
+            prompt_id, number = self.comfy.enqueue(prompt, request.get('client_id'))
+            self.send_json({"prompt_id": prompt_id, "number": number, "node_errors": {}})
+        elif url.path == '/queue':
+            request = self.read_json()
+            if request.get('clear'):
+                self.comfy.delete({item[1] for item in list(self.comfy.queue)})
+            if 'delete' in request:
+                self.comfy.delete(set(request['delete']))
+            self.send_json({})
+        elif url.path == '/interrupt':
+            request = self.read_json()
+            self.comfy.interrupt(request.get('prompt_id'))
+            self.send_json({})
+        elif url.path == '/upload/image':
+            self.upload_image()
+        else:
+            self.send_error(404)
+
+    def upload_image(self): # Parses the multipart form the way ComfyUI's /upload/image does: 'image' file plus optional overwrite, subfolder and type
+        header = f"Content-Type: {self.headers.get('Content-Type')}\r\n\r\n".encode('latin-1')
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(header + self.read_body())
+        fields = {}
+        image = None
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            if name == 'image':
+                image = (os.path.basename(part.get_filename() or 'image.png'), part.get_payload(decode=True))
+            elif name:
+                fields[name] = part.get_payload(decode=True).decode('utf-8')
+        if image is None:
+            self.send_error(400)
+            return
+        filename, data = image
+        subfolder = fields.get('subfolder', '')
+        folder = os.path.join(self.comfy.args.input_dir, subfolder)
+        os.makedirs(folder, exist_ok=True)
+        if fields.get('overwrite', 'false').lower() != 'true': # Without overwrite, ComfyUI keeps identical files and renames different ones
+            base, extension = os.path.splitext(filename)
+            index = 1
+            while os.path.exists(os.path.join(folder, filename)):
+                with open(os.path.join(folder, filename), 'rb') as file:
+                    if hashlib.sha256(file.read()).digest() == hashlib.sha256(data).digest():
+                        break
+                filename = f"{base} ({index}){extension}"
+                index += 1
+        with open(os.path.join(folder, filename), 'wb') as file:
+            file.write(data)
+        self.send_json({"name": filename, "subfolder": subfolder, "type": fields.get('type', 'input')})
+
+    def serve_file(self, filename, subfolder, folder_type):
+        root = self.comfy.args.input_dir if folder_type == 'input' else self.comfy.args.output_dir
+        path = os.path.realpath(os.path.join(root, subfolder, filename))
+        if not path.startswith(os.path.realpath(root) + os.sep) or not os.path.isfile(path):
+            self.send_error(404)
+            return
+        with open(path, 'rb') as file:
+            body = file.read()
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def serve_websocket(self, client_id): # Upgrades the connection, then reads client frames until it closes; events are pushed by the executor
+        key = self.headers.get('Sec-WebSocket-Key')
+        if self.headers.get('Upgrade', '').lower() != 'websocket' or not key:
+            self.send_error(400)
+            return
+        accept = base64.b64encode(hashlib.sha1((key + WS_GUID).encode('ascii')).digest()).decode('ascii')
+        self.send_response(101, 'Switching Protocols')
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept)
+        self.end_headers()
+        self.wfile.flush()
+        client = WebSocketClient(client_id, self.wfile)
+        self.comfy.clients[client_id] = client
+        client.send_json({"type": "status", "data": {"status": {"exec_info": {"queue_remaining": self.comfy.queue_remaining()}}, "sid": client_id}})
+        try:
+            while client.open:
+                header = self.rfile.read(2)
+                if len(header) < 2:
+                    break
+                opcode = header[0] & 0x0f
+                length = header[1] & 0x7f
+                if length == 126:
+                    length = struct.unpack('>H', self.rfile.read(2))[0]
+                elif length == 127:
+                    length = struct.unpack('>Q', self.rfile.read(8))[0]
+                mask = self.rfile.read(4) if header[1] & 0x80 else b'\x00' * 4
+                payload = bytes(byte ^ mask[i % 4] for i, byte in enumerate(self.rfile.read(length)))
+                if opcode == 0x8: # Close: echo it and stop
+                    client.send(0x8, payload[:2])
+                    break
+                if opcode == 0x9: # Ping
+                    client.send(0xA, payload)
+        except OSError:
+            pass
+        finally:
+            client.open = False
+            if self.comfy.clients.get(client_id) is client:
+                del self.comfy.clients[client_id]
+            self.close_connection = True
+
+def watch_parent(parent_pid): # Exits when the worker that spawned us is gone, so an interrupted benchmark leaves no server behind
+    while os.getppid() == parent_pid:
+        time.sleep(1)
+    os._exit(0)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--listen', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8188)
+    parser.add_argument('--sampling-delay', type=float, default=0.5, help='Seconds each sampler node takes for a batch of one')
+    parser.add_argument('--batch-cost', type=float, default=0.35, help='Extra sampling time of each additional image in a latent batch, as a share of the first')
+    parser.add_argument('--steps', type=int, default=20, help='Progress events sent per sampler node')
+    parser.add_argument('--output-size', type=int, default=0, help='Width and height of the outputs; 0 uses the latent node size')
+    parser.add_argument('--output-entropy', type=float, default=0.5, help='Share of each row that is noise; controls the PNG size')
+    parser.add_argument('--history-delay', type=float, default=0.05, help='Seconds between execution_success and the /history entry, as between execute() and task_done() in ComfyUI')
+    parser.add_argument('--output-dir', default='fake_comfy/output')
+    parser.add_argument('--input-dir', default='fake_comfy/input')
+    parser.add_argument('--startup-delay', type=float, default=float(os.getenv('FAKE_COMFY_STARTUP_DELAY', '0')), help='Seconds before the server starts listening, as ComfyUI loading its nodes; defaults to FAKE_COMFY_STARTUP_DELAY, so a benchmark can slow down restarts only')
+    args, _ = parser.parse_known_args() # The worker passes real ComfyUI flags too
+    time.sleep(args.startup_delay)
+    server = ThreadingHTTPServer((args.listen, args.port), FakeComfyHandler)
+    server.daemon_threads = True
+    server.comfy = FakeComfy(args)
+    threading.Thread(target=watch_parent, args=(os.getppid(),), daemon=True).start()
+    print(f"Fake ComfyUI listening on {args.listen}:{args.port}")
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
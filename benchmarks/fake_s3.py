@@ -0,0 +1,68 @@
+#### In-process S3 stand-in for the worker benchmarks - the boto3 client calls AWSConnector makes, on an in-memory bucket with optional latency and bandwidth
+# Usage: install it before the first job with `AWSConnector().reset_s3_client(FakeS3Client(latency=0.02, bandwidth_mbps=200))`
+
+import hashlib
+import threading
+import time
+from botocore.exceptions import ClientError
+
+class FakeS3Client: # Thread-safe like a boto3 client; objects live in memory, keyed by (bucket, key)
+    def __init__(self, latency=0.0, bandwidth_mbps=0.0):
+        self.latency = latency # Seconds added to every request, as the round trip to S3
+        self.bandwidth_mbps = bandwidth_mbps # Transfer rate of object bodies in megabytes per second; 0 is unlimited
+        self.objects = {} # (bucket, key) -> bytes
+        self.lock = threading.Lock()
+        self.calls = {} # Operation -> number of calls, for the benchmark report
+
+    def simulate(self, operation, size=0): # Sleeps as long as the request would take
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+        delay = self.latency + (size / (self.bandwidth_mbps * 1024 * 1024) if self.bandwidth_mbps else 0)
+        if delay:
+            time.sleep(delay)
+
+    def get(self, bucket, key):
+        with self.lock:
+            data = self.objects.get((bucket, key))
+        if data is None:
+            raise ClientError({"Error": {"Code": "404", "Message": "Not Found"}}, 'HeadObject')
+        return data
+
+    def put_object(self, Bucket, Key, Body): # Seeds inputs and models; not used by the worker itself
+        self.simulate('put_object', len(Body))
+        with self.lock:
+            self.objects[(Bucket, Key)] = bytes(Body)
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, Config=None, ExtraArgs=None):
+        data = Fileobj.read()
+        self.simulate('upload_fileobj', len(data))
+        with self.lock:
+            self.objects[(Bucket, Key)] = data
+
+    def download_fileobj(self, Bucket, Key, Fileobj, Config=None, ExtraArgs=None):
+        data = self.get(Bucket, Key)
+        self.simulate('download_fileobj', len(data))
+        Fileobj.write(data)
+
+    def head_object(self, Bucket, Key):
+        data = self.get(Bucket, Key)
+        self.simulate('head_object')
+        return {"ETag": f'"{hashlib.md5(data).hexdigest()}"', "ContentLength": len(data)} # Single-part ETag, as S3 reports it
+
+    def upload_file(self, Filename, Bucket, Key, Config=None, ExtraArgs=None):
+        with open(Filename, 'rb') as file:
+            self.upload_fileobj(file, Bucket, Key)
+
+    def download_file(self, Bucket, Key, Filename, Config=None, ExtraArgs=None):
+        data = self.get(Bucket, Key)
+        self.simulate('download_file', len(data))
+        with open(Filename, 'wb') as file:
+            file.write(data)
+
+    def keys(self, bucket):
+        with self.lock:
+            return [key for object_bucket, key in self.objects if object_bucket == bucket]
+
+    def total_bytes(self, bucket):
+        with self.lock:
+            return sum(len(data) for (object_bucket, key), data in self.objects.items() if object_bucket == bucket)
@@ -1,113 +1,250 @@
 #### Distillery AWS Connector Lite Sync - v2.4 - Aug 30 2023 - AWS Manager and Database Connector for backup server
 
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from watchtower import CloudWatchLogHandler
-from typing import List, Tuple
+from typing import List, Tuple, NamedTuple, Optional
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import os
+import sys
 import logging
-import inspect
 import time
 from io import BytesIO
 import json
-import time
 import socket
+import queue
+import random
+import atexit
+import signal
 from botocore.exceptions import ClientError
 
 APP_NAME = os.getenv('APP_NAME')
 AWS_REGION_NAME = os.getenv('AWS_REGION_NAME')
 AWS_LOG_GROUP = os.getenv('AWS_LOG_GROUP')
 AWS_LOG_STREAM_NAME = os.getenv('AWS_LOG_STREAM_NAME')
+METRICS_LOG_STREAM_NAME = os.getenv('METRICS_LOG_STREAM_NAME') or f"{AWS_LOG_STREAM_NAME}-metrics" # Stream for CloudWatch Embedded Metric Format records; created if missing
 AWS_S3_BUCKET_NAME = os.getenv('AWS_S3_BUCKET_NAME')
 AWS_S3_ACCESS_KEY = os.getenv('AWS_S3_ACCESS_KEY')
 AWS_S3_SECRET_KEY = os.getenv('AWS_S3_SECRET_KEY')
+AWS_S3_ENDPOINT_URL = os.getenv('AWS_S3_ENDPOINT_URL') or None # Optional custom S3 endpoint, e.g. a MinIO-compatible server or a local stand-in; leave unset for AWS
+S3_MAX_POOL_CONNECTIONS = int(os.getenv('S3_MAX_POOL_CONNECTIONS', '32')) # Size of the HTTP connection pool shared by all S3 calls
+S3_MULTIPART_THRESHOLD_MB = int(os.getenv('S3_MULTIPART_THRESHOLD_MB', '16')) # Files larger than this are transferred in multiple parts
+S3_MULTIPART_CHUNKSIZE_MB = int(os.getenv('S3_MULTIPART_CHUNKSIZE_MB', '8')) # Size of each part of a multipart transfer
+S3_TRANSFER_CONCURRENCY = int(os.getenv('S3_TRANSFER_CONCURRENCY', '8')) # Threads used for the parts of a single multipart transfer
+S3_BATCH_CONCURRENCY = int(os.getenv('S3_BATCH_CONCURRENCY', '8')) # Number of keys the batch methods move in parallel
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper() # Minimum level that print_log (and the root logger) will emit
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000')) # Records buffered for the background log thread; records beyond this are dropped and counted
+LOG_BATCH_SIZE = int(os.getenv('LOG_BATCH_SIZE', '200')) # Maximum records the background log thread hands to the handlers per wake-up
+LOG_FLUSH_INTERVAL = float(os.getenv('LOG_FLUSH_INTERVAL', '1.0')) # Maximum seconds a record waits in the queue before being emitted
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', '1.0')) # Fraction of print_log(..., sampled=True) calls that are kept; use it for chatty per-iteration messages
+LOG_CALLER_INFO = os.getenv('LOG_CALLER_INFO', 'true').lower() == 'true' # Whether to record script, function and line of the print_log caller
+LOG_SHUTDOWN_TIMEOUT = float(os.getenv('LOG_SHUTDOWN_TIMEOUT', '5.0')) # Seconds to wait for queued logs to be shipped at shutdown
+
+def level_number(level): # Numeric logging level for a name such as 'INFO'; unknown names count as INFO
+    levelno = logging.getLevelName(str(level).upper())
+    return levelno if isinstance(levelno, int) else logging.INFO
+
+class TransferResult(NamedTuple): # Outcome of transferring one key; file_obj is only set by download_fileobj and etag only by head_objects
+    key: str
+    success: bool
+    error: Optional[str] = None
+    file_obj: Optional[BytesIO] = None
+    etag: Optional[str] = None
 
 class AWSConnector:
     _instance = None
+    _instance_lock = threading.Lock()
 
     def __new__(cls):
-        if not cls._instance:
-            cls._instance = super().__new__(cls)
-            cls._instance.region_name = AWS_REGION_NAME
-            cls._instance.log_group = AWS_LOG_GROUP
-            cls._instance.log_stream_name = AWS_LOG_STREAM_NAME
-            cls._instance.setup_logging()
+        with cls._instance_lock: # The connector is shared by the upload, download and logging threads
+            if not cls._instance:
+                instance = super().__new__(cls)
+                instance.region_name = AWS_REGION_NAME
+                instance.log_group = AWS_LOG_GROUP
+                instance.log_stream_name = AWS_LOG_STREAM_NAME
+                instance._s3_client = None
+                instance._s3_client_lock = threading.Lock()
+                instance.transfer_config = TransferConfig(multipart_threshold=S3_MULTIPART_THRESHOLD_MB * 1024 * 1024, multipart_chunksize=S3_MULTIPART_CHUNKSIZE_MB * 1024 * 1024, max_concurrency=S3_TRANSFER_CONCURRENCY, use_threads=True)
+                instance.transfer_pool = ThreadPoolExecutor(max_workers=S3_BATCH_CONCURRENCY, thread_name_prefix='distillery-s3')
+                instance.hostname = socket.gethostname() # Cached: it does not change during the life of the worker
+                instance.log_level = level_number(LOG_LEVEL)
+                instance.log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+                instance.dropped_logs = 0
+                instance.dropped_logs_lock = threading.Lock()
+                instance.reported_dropped_logs = 0
+                instance.setup_logging(level=instance.log_level)
+                instance.start_log_thread()
+                cls._instance = instance
         return cls._instance
+
+    @property
+    def s3(self): # One long-lived S3 client for the whole worker; boto3 clients are thread-safe, so all threads share its connection pool
+        if self._s3_client is None:
+            with self._s3_client_lock:
+                if self._s3_client is None:
+                    client_config = Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS, retries={'max_attempts': 5, 'mode': 'adaptive'})
+                    self._s3_client = boto3.client('s3', aws_access_key_id=AWS_S3_ACCESS_KEY, aws_secret_access_key=AWS_S3_SECRET_KEY, region_name=AWS_REGION_NAME, endpoint_url=AWS_S3_ENDPOINT_URL, config=client_config)
+        return self._s3_client
+
+    def reset_s3_client(self, client=None): # Drops the cached client so the next call builds a new one (e.g. after a credentials or endpoint change), or installs client in its place (e.g. the benchmarks' in-memory S3)
+        with self._s3_client_lock:
+            self._s3_client = client
     
-    def setup_logging(self, level=logging.DEBUG): 
+    def setup_logging(self, level=logging.INFO): 
         root_logger = logging.getLogger()
         root_logger.setLevel(level)
+        self.metrics_logger = logging.getLogger('distillery.metrics') # EMF records must be the whole log event, so they bypass the root formatter
+        self.metrics_logger.propagate = False
+        self.metrics_logger.setLevel(logging.INFO)
+        if not self.log_group: # Local runs (benchmarks, development) have no CloudWatch; records go nowhere and messages are still printed where the code prints them
+            return
         session = boto3.Session(region_name=self.region_name)
         cloudwatch_client = session.client('logs')
         cw_handler = CloudWatchLogHandler(boto3_client=cloudwatch_client, log_group=self.log_group, stream_name=self.log_stream_name, create_log_group=False, create_log_stream=False)
         formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
         cw_handler.setFormatter(formatter)
         root_logger.addHandler(cw_handler)
+        metrics_handler = CloudWatchLogHandler(boto3_client=cloudwatch_client, log_group=self.log_group, stream_name=METRICS_LOG_STREAM_NAME, create_log_group=False, create_log_stream=True)
+        metrics_handler.setFormatter(logging.Formatter('%(message)s'))
+        self.metrics_logger.addHandler(metrics_handler)
+
+    def emit_metrics(self, record): # Ships one CloudWatch Embedded Metric Format record; CloudWatch extracts the metrics from it
+        self.metrics_logger.info(json.dumps(record, separators=(',', ':')))
+
+    def start_log_thread(self): # Starts the background thread that ships queued records and registers the shutdown flush
+        self.log_thread = threading.Thread(target=self.drain_logs, name='distillery-log', daemon=True)
+        self.log_thread.start()
+        atexit.register(self.flush_logs)
+        if threading.current_thread() is threading.main_thread() and signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum)) # Turn SIGTERM into a normal exit so the atexit flush runs
+
+    def print_log(self, request_id, context, message, level='INFO', sampled=False): # Never blocks: the record is queued and shipped by the background log thread
+        levelno = level_number(level)
+        if levelno < self.log_level:
+            return
+        if sampled and random.random() >= LOG_SAMPLE_RATE:
+            return
+        caller = None
+        if LOG_CALLER_INFO:
+            caller_frame = sys._getframe(1) # Only the raw code object and line are kept here; formatting happens in the log thread
+            caller = (caller_frame.f_code, caller_frame.f_lineno)
+        try:
+            self.log_queue.put_nowait((levelno, time.time(), request_id, context, message, caller))
+        except queue.Full:
+            with self.dropped_logs_lock:
+                self.dropped_logs += 1
+
+    def drain_logs(self): # Runs in the background log thread
+        while True:
+            batch = []
+            try:
+                batch.append(self.log_queue.get(timeout=LOG_FLUSH_INTERVAL))
+                while len(batch) < LOG_BATCH_SIZE:
+                    batch.append(self.log_queue.get_nowait())
+            except queue.Empty:
+                pass
+            for record in batch:
+                try:
+                    self.emit_log(*record)
+                except Exception as e:
+                    print(f"Error emitting log record: {e}")
+                finally:
+                    self.log_queue.task_done()
+            dropped_logs = self.dropped_logs
+            if dropped_logs > self.reported_dropped_logs:
+                logging.warning(json.dumps({"context": APP_NAME, "timestamp": f"{time.time():.3f}", "message": f"Log queue full: {dropped_logs - self.reported_dropped_logs} records dropped ({dropped_logs} in total)", "hostname": self.hostname}))
+                self.reported_dropped_logs = dropped_logs
 
-    def print_log(self, request_id, context, message, level='INFO'): 
-        caller_frame = inspect.currentframe().f_back
-        script_name = os.path.basename(caller_frame.f_globals["__file__"])
-        line_number = caller_frame.f_lineno
-        function_name = caller_frame.f_code.co_name
-        hostname = socket.gethostname() 
+    def emit_log(self, levelno, timestamp, request_id, context, message, caller):
         log_data = {
             "context": context,
-            "timestamp": f"{time.time():.3f}",
+            "timestamp": f"{timestamp:.3f}",
             "request_id": request_id,
             "message": message,
-            "script_name": script_name,
-            "function_name": function_name,
-            "line_number": line_number,
-            "hostname": hostname
+            "hostname": self.hostname
         }
-        message_to_print = json.dumps(log_data)
-        if level == 'INFO':
-            logging.info(message_to_print)
-        elif level == 'ERROR':
-            logging.error(message_to_print)
-        elif level == 'WARNING':
-            logging.warning(message_to_print)
-
-    def upload_fileobj(self, files: List[Tuple[BytesIO, str]]):
-        s3 = boto3.client('s3', aws_access_key_id=AWS_S3_ACCESS_KEY, aws_secret_access_key=AWS_S3_SECRET_KEY, region_name=AWS_REGION_NAME)
-        try:
-            for file_obj, key in files:
+        if caller is not None:
+            code, line_number = caller
+            log_data["script_name"] = os.path.basename(code.co_filename)
+            log_data["function_name"] = code.co_name
+            log_data["line_number"] = line_number
+        logging.log(levelno, json.dumps(log_data))
+
+    def flush_logs(self, timeout=LOG_SHUTDOWN_TIMEOUT): # Waits until every queued record has been handed to the handlers, then flushes them (CloudWatch included)
+        deadline = time.time() + timeout
+        while self.log_queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.05)
+        for handler in logging.getLogger().handlers + self.metrics_logger.handlers:
+            try:
+                handler.flush()
+            except Exception as e:
+                print(f"Error flushing log handler {handler}: {e}")
+
+    def run_batch(self, transfer, items) -> List[TransferResult]: # Runs transfer(item) for every item, in parallel, and returns the results in the same order
+        if len(items) <= 1: # Skip the thread hop for the very common single-file case
+            return [transfer(item) for item in items]
+        return list(self.transfer_pool.map(transfer, items))
+
+    def upload_fileobj(self, files: List[Tuple[BytesIO, str]]) -> List[TransferResult]:
+        def upload(item):
+            file_obj, key = item
+            try:
                 file_obj.seek(0)  # Ensure we're at the start of the file
-                s3.upload_fileobj(file_obj, AWS_S3_BUCKET_NAME, key)
-        except Exception as e:
-            self.print_log('N/A', APP_NAME, f"Error uploading file objects to AWS S3 bucket {AWS_S3_BUCKET_NAME}: {e}", level='ERROR')
+                self.s3.upload_fileobj(file_obj, AWS_S3_BUCKET_NAME, key, Config=self.transfer_config)
+                return TransferResult(key, True)
+            except Exception as e:
+                self.print_log('N/A', APP_NAME, f"Error uploading file object with key {key} to AWS S3 bucket {AWS_S3_BUCKET_NAME}: {e}", level='ERROR')
+                return TransferResult(key, False, str(e))
+        return self.run_batch(upload, files)
 
-    def download_fileobj(self, keys: List[str]) -> List[BytesIO]:
-        file_objs = []
-        try:
-            s3 = boto3.client('s3', aws_access_key_id=AWS_S3_ACCESS_KEY, aws_secret_access_key=AWS_S3_SECRET_KEY, region_name=AWS_REGION_NAME)
-            for key in keys:
-                try:
-                    file_obj = BytesIO()
-                    s3.download_fileobj(AWS_S3_BUCKET_NAME, key, file_obj)
-                    file_obj.seek(0)  # Ensure we're at the start of the file
-                    file_objs.append(file_obj)
-                except ClientError as e:
-                    if e.response['Error']['Code'] == '404':
-                        self.print_log('N/A', APP_NAME, f"File with key {key} was not found in AWS S3 bucket {AWS_S3_BUCKET_NAME}", level='ERROR')
-                    else:
-                        self.print_log('N/A', APP_NAME, f"Error downloading file with key {key} from AWS S3 bucket {AWS_S3_BUCKET_NAME}: {e}", level='ERROR')
-            return file_objs
-        except Exception as e:
-            self.print_log('N/A', APP_NAME, f"Error downloading file objects from AWS S3 bucket {AWS_S3_BUCKET_NAME}: {e}", level='ERROR')
-            return file_objs
-
-    def upload_files(self, files: List[Tuple[str, str]]):
-        s3 = boto3.client('s3', aws_access_key_id=AWS_S3_ACCESS_KEY, aws_secret_access_key=AWS_S3_SECRET_KEY, region_name=AWS_REGION_NAME)
-        try:
-            for file_name, key in files:
-                s3.upload_file(file_name, AWS_S3_BUCKET_NAME, key)
-        except Exception as e:
-            self.print_log('N/A', APP_NAME, f"Error uploading files to AWS S3 bucket {AWS_S3_BUCKET_NAME}: {e}", level='ERROR')
+    def download_fileobj(self, keys: List[str]) -> List[TransferResult]:
+        def download(key):
+            try:
+                file_obj = BytesIO()
+                self.s3.download_fileobj(AWS_S3_BUCKET_NAME, key, file_obj, Config=self.transfer_config)
+                file_obj.seek(0)  # Ensure we're at the start of the file
+                return TransferResult(key, True, file_obj=file_obj)
+            except ClientError as e:
+                if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                    self.print_log('N/A', APP_NAME, f"File with key {key} was not found in AWS S3 bucket {AWS_S3_BUCKET_NAME}", level='ERROR')
+                else:
+                    self.print_log('N/A', APP_NAME, f"Error downloading file with key {key} from AWS S3 bucket {AWS_S3_BUCKET_NAME}: {e}", level='ERROR')
+                return TransferResult(key, False, str(e))
+            except Exception as e:
+                self.print_log('N/A', APP_NAME, f"Error downloading file with key {key} from AWS S3 bucket {AWS_S3_BUCKET_NAME}: {e}", level='ERROR')
+                return TransferResult(key, False, str(e))
+        return self.run_batch(download, keys)
 
-    def download_files(self, files: List[Tuple[str, str]]):
-        s3 = boto3.client('s3', aws_access_key_id=AWS_S3_ACCESS_KEY, aws_secret_access_key=AWS_S3_SECRET_KEY, region_name=AWS_REGION_NAME)
-        try:
-            for key, file_name in files:
-                s3.download_file(AWS_S3_BUCKET_NAME, key, file_name)
-        except Exception as e:
-            self.print_log('N/A', APP_NAME, f"Error downloading files from AWS S3 bucket {AWS_S3_BUCKET_NAME}: {e}", level='ERROR')
+    def head_objects(self, keys: List[str]) -> List[TransferResult]: # Fetches the ETag of every key without downloading it
+        def head(key):
+            try:
+                response = self.s3.head_object(Bucket=AWS_S3_BUCKET_NAME, Key=key)
+                return TransferResult(key, True, etag=response['ETag'])
+            except Exception as e:
+                self.print_log('N/A', APP_NAME, f"Error reading metadata of key {key} in AWS S3 bucket {AWS_S3_BUCKET_NAME}: {e}", level='ERROR')
+                return TransferResult(key, False, str(e))
+        return self.run_batch(head, keys)
+
+    def upload_files(self, files: List[Tuple[str, str]]) -> List[TransferResult]:
+        def upload(item):
+            file_name, key = item
+            try:
+                self.s3.upload_file(file_name, AWS_S3_BUCKET_NAME, key, Config=self.transfer_config)
+                return TransferResult(key, True)
+            except Exception as e:
+                self.print_log('N/A', APP_NAME, f"Error uploading file {file_name} to AWS S3 bucket {AWS_S3_BUCKET_NAME}: {e}", level='ERROR')
+                return TransferResult(key, False, str(e))
+        return self.run_batch(upload, files)
+
+    def download_files(self, files: List[Tuple[str, str]]) -> List[TransferResult]:
+        def download(item):
+            key, file_name = item
+            try:
+                self.s3.download_file(AWS_S3_BUCKET_NAME, key, file_name, Config=self.transfer_config)
+                return TransferResult(key, True)
+            except Exception as e:
+                self.print_log('N/A', APP_NAME, f"Error downloading file with key {key} from AWS S3 bucket {AWS_S3_BUCKET_NAME}: {e}", level='ERROR')
+                return TransferResult(key, False, str(e))
+        return self.run_batch(download, files)
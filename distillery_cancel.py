@@ -0,0 +1,64 @@
+#### Distillery Cancel - Cooperative cancellation shared by every stage of a job
+
+import threading
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+CANCEL_POLL_INTERVAL = 0.5 # Seconds between cancellation checks while blocked on a semaphore or a future
+
+class JobCancelled(RuntimeError): # Raised inside a job once its token is cancelled; not an error of the stage that raises it
+    pass
+
+class CancelToken: # Set once by the handler on timeout or client cancel; stages check it and register cleanups that must run right away
+    def __init__(self):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.callbacks = []
+        self.reason = None
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def cancel(self, reason='Job cancelled'): # Runs every registered cleanup once, in the calling thread
+        with self.lock:
+            if self.event.is_set():
+                return
+            self.reason = reason
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e: # One failing cleanup must not stop the others
+                print(f"Error in cancel callback: {e}")
+
+    def on_cancel(self, callback): # Registers callback to run on cancel, right away if already cancelled; returns a function that unregisters it
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return lambda: self.remove(callback)
+        callback()
+        return lambda: None
+
+    def remove(self, callback):
+        with self.lock:
+            if callback in self.callbacks:
+                self.callbacks.remove(callback)
+
+    def raise_if_cancelled(self):
+        if self.event.is_set():
+            raise JobCancelled(self.reason)
+
+    def acquire(self, semaphore): # semaphore.acquire() that gives up once the job is cancelled
+        while not semaphore.acquire(timeout=CANCEL_POLL_INTERVAL):
+            self.raise_if_cancelled()
+        if self.event.is_set():
+            semaphore.release()
+            self.raise_if_cancelled()
+
+    def result(self, future): # future.result() that gives up once the job is cancelled
+        while True:
+            try:
+                return future.result(timeout=CANCEL_POLL_INTERVAL)
+            except FutureTimeoutError:
+                self.raise_if_cancelled()
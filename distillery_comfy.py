@@ -1,18 +1,24 @@
 
 import uuid
 import json
-import urllib.request
-import urllib.parse
-from PIL import Image
-from websocket import WebSocket # note: websocket-client (https://github.com/websocket-client/websocket-client)
-import io
+from websocket import WebSocket, ABNF, WebSocketTimeoutException # note: websocket-client (https://github.com/websocket-client/websocket-client)
 import requests
+from requests.adapters import HTTPAdapter
 import time
 import os
 import subprocess
-import tempfile
+import socket
+import mmap
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
+from collections import OrderedDict
 from distillery_aws import AWSConnector
+from distillery_models import ModelCache, find_workflow_models
+from distillery_templates import TemplateCache
+from distillery_cancel import JobCancelled
+from distillery_metrics import JobTrace, MetricsRegistry
 import sys
 
 APP_NAME = os.getenv('APP_NAME') # Name of the application
@@ -20,129 +26,398 @@ API_COMMAND_LINE = os.getenv('API_COMMAND_LINE') # Command line to start the API
 API_URL = os.getenv('API_URL')  # URL of the API server (warning: do not add the port number to the URL as it will be passed later)
 INITIAL_PORT = int(os.getenv('INITIAL_PORT')) # Initial port to use when starting the API server; may be changed if the port is already in use
 INSTANCE_IDENTIFIER = APP_NAME+'-'+str(uuid.uuid4()) # Unique identifier for this instance of the worker
-TEST_PAYLOAD = json.load(open(os.getenv('TEST_PAYLOAD'))) # The TEST_PAYLOAD is a JSON object that contains a prompt that will be used to test if the API server is running
-MAX_COMFY_START_ATTEMPTS = 20  # Set this to the maximum number of attempts you want
+TEST_PAYLOAD = json.load(open(os.getenv('TEST_PAYLOAD'))) if os.getenv('TEST_PAYLOAD') else None # The TEST_PAYLOAD is a JSON object that contains a prompt that is run once at startup to warm up the API server
+COMFY_START_TIMEOUT = float(os.getenv('COMFY_START_TIMEOUT', '300')) # Seconds to wait for the API server to answer HTTP after spawning it
+COMFY_PROBE_INITIAL_DELAY = float(os.getenv('COMFY_PROBE_INITIAL_DELAY', '0.05')) # First delay between liveness probes; doubles after every failed probe
+COMFY_PROBE_MAX_DELAY = float(os.getenv('COMFY_PROBE_MAX_DELAY', '1.0')) # Upper bound for the delay between liveness probes
+COMFY_PROBE_TIMEOUT = float(os.getenv('COMFY_PROBE_TIMEOUT', '2.0')) # HTTP timeout of a single liveness probe
+COMFY_UPLOAD_THREADS = int(os.getenv('COMFY_UPLOAD_THREADS', '4')) # Number of input images uploaded to the API server in parallel
+COMFY_HTTP_POOL_SIZE = int(os.getenv('COMFY_HTTP_POOL_SIZE', '16')) # Keep-alive connections kept open to the API server
+COMFY_HTTP_TIMEOUT = float(os.getenv('COMFY_HTTP_TIMEOUT', '60')) # Timeout of REST calls to the API server
+COMFY_OUTPUT_FOLDER = os.getenv('COMFY_OUTPUT_FOLDER') # ComfyUI output folder, e.g. "ComfyUI/output"; when set, outputs are read from disk instead of downloaded through /view
+COMFY_WARMUP = os.getenv('COMFY_WARMUP', 'true').lower() == 'true' # Whether to run TEST_PAYLOAD once at startup to preload its checkpoint
+COMFY_BACKEND_ARGS = json.loads(os.getenv('COMFY_BACKEND_ARGS') or '[]') # Extra command line arguments per backend as a JSON list, e.g. '["--cuda-device 0", "--cuda-device 1", "--cpu"]'; one backend is started per entry
+COMFY_BACKENDS = len(COMFY_BACKEND_ARGS) or int(os.getenv('COMFY_BACKENDS', '1')) # Number of ComfyUI processes to run when COMFY_BACKEND_ARGS is not set
+COMFY_BACKENDS_SHARE_INPUTS = os.getenv('COMFY_BACKENDS_SHARE_INPUTS', 'true').lower() == 'true' # Whether the backends read the same input folder (true when they run from one ComfyUI install)
+COMFY_AFFINITY_SLACK = int(os.getenv('COMFY_AFFINITY_SLACK', '1')) # Extra queued prompts tolerated on a backend that already ran the job's checkpoint before picking a less loaded one
+COMFY_SUPERVISE_INTERVAL = float(os.getenv('COMFY_SUPERVISE_INTERVAL', '5')) # Seconds between checks for crashed backends
+COMFY_WS_IDLE_TIMEOUT = float(os.getenv('COMFY_WS_IDLE_TIMEOUT', '5')) # Seconds of WebSocket silence after which pending prompts are checked against /history
+COMFY_PROMPT_TIMEOUT = float(os.getenv('COMFY_PROMPT_TIMEOUT', '0')) # Maximum seconds to wait for a single prompt once the previous one finished; 0 disables the limit
+COMFY_FORWARD_PREVIEWS = os.getenv('COMFY_FORWARD_PREVIEWS', 'false').lower() == 'true' # Whether binary preview frames are passed to event callbacks; otherwise they are dropped without decoding
+MAX_QUEUED_PROMPTS = int(os.getenv('MAX_QUEUED_PROMPTS', '16')) # Prompts this worker keeps queued in ComfyUI across all jobs and backends; later seeds are queued as earlier ones finish
+RECENT_MODELS_PER_BACKEND = 8 # Checkpoints remembered per backend for model affinity
 
-class ComfyConnector:
-    _instance = None
-    _process = None
-
-    def __new__(cls, *args, **kwargs):
-        if cls._instance is None:
-            cls._instance = super(ComfyConnector, cls).__new__(cls)
-        return cls._instance
+def input_filename(s3_key, content_hash): # Name of an input in ComfyUI's input folder; prefixed with its content hash so keys sharing a file name never overwrite each other's image
+    return f"{content_hash[:16]}_{os.path.basename(s3_key)}"
 
+class InputCache: # What an input folder currently holds; shared by backends that read the same folder
     def __init__(self):
-        if not hasattr(self, 'initialized'):
-            self.urlport = self.find_available_port()
-            self.server_address = f"http://{API_URL}:{self.urlport}"
-            self.client_id = INSTANCE_IDENTIFIER
-            self.ws_address = f"ws://{API_URL}:{self.urlport}/ws?clientId={self.client_id}"
-            self.ws = WebSocket()
-            self.start_api()
-            self.initialized = True
-
-    def find_available_port(self): # If the initial port is already in use, this method finds an available port to start the API server on
-        port = INITIAL_PORT
-        while True:
+        self.entries = {} # S3 key -> {'etag', 'name'} of the content last uploaded to ComfyUI's input folder
+        self.uploaded = set() # Input file names ComfyUI currently holds; each name stands for one content
+        self.lock = threading.Lock()
+
+    def current_name(self, s3_key, etag): # Must be called with lock held; the input file name holding this exact S3 object, or None if it has to be uploaded
+        cached = self.entries.get(s3_key)
+        if cached is not None and cached['etag'] == etag and cached['name'] in self.uploaded:
+            return cached['name']
+        return None
+
+class PromptTracker: # State of one queued prompt, fed by the backend's WebSocket demultiplexer
+    def __init__(self, prompt_id, on_event=None, slot=None, queued_at=None):
+        self.prompt_id = prompt_id
+        self.slot = slot # Semaphore slot in the worker-wide prompt queue, released when the prompt is done
+        self.on_event = on_event # Optional callback(event_type, data) for progress, executing, executed, execution_cached and preview events
+        self.done = threading.Event()
+        self.finish_lock = threading.Lock()
+        self.error = None
+        self.queued_at = queued_at or time.time() # Taken before the POST by queue_prompt, as the prompt can start before the response arrives
+        self.started_at = None
+        self.finished_at = None
+
+    def emit(self, event_type, data):
+        if self.on_event is not None:
             try:
-                response = requests.get(f'http://{API_URL}:{port}')
-                if response.status_code != 200:
-                    return port
-                else:
-                    port += 1
-            except requests.ConnectionError:
-                return port
+                self.on_event(event_type, data)
+            except Exception as e: # A misbehaving consumer must never take down the listener
+                print(f"Error in event callback of prompt {self.prompt_id}: {e}")
+
+    def finish(self, error=None):
+        with self.finish_lock: # The listener, the supervisor and a timed out waiter may all try to finish a prompt
+            if self.done.is_set():
+                return
+            self.error = error
+            self.finished_at = time.time()
+            if self.slot is not None:
+                self.slot.release()
+            self.done.set()
+
+    def wait(self, timeout=None): # Blocks until the prompt is done or timeout elapses; returns whether it is done
+        return self.done.wait(timeout)
+
+class ComfyBackend: # One ComfyUI process on its own port, with its own HTTP session and WebSocket listener
+    def __init__(self, index, urlport, extra_args, input_cache, prompt_slots):
+        self.index = index
+        self.prompt_slots = prompt_slots # Shared by all backends: caps the prompts this worker has queued in ComfyUI
+        self.urlport = urlport
+        self.extra_args = extra_args
+        self.server_address = f"http://{API_URL}:{self.urlport}"
+        self.client_id = f"{INSTANCE_IDENTIFIER}-{index}"
+        self.ws_address = f"ws://{API_URL}:{self.urlport}/ws?clientId={self.client_id}"
+        self.ws = None
+        self._process = None
+        self.healthy = False
+        self.session = requests.Session() # Keep-alive session shared by every REST call to the API server
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=COMFY_HTTP_POOL_SIZE))
+        self.input_cache = input_cache
+        self.input_upload_pool = ThreadPoolExecutor(max_workers=COMFY_UPLOAD_THREADS, thread_name_prefix=f'distillery-input-{index}')
+        self.prompts = {} # Prompt id -> PromptTracker for prompts queued by this worker and not finished yet
+        self.unclaimed_prompts = {} # Prompt id -> (time it finished, error), for completions that arrived before queue_prompt returned
+        self.unclaimed_starts = {} # Prompt id -> time it started, for prompts that started before queue_prompt returned
+        self.executing_prompt_id = None # Prompt currently running on the server, as seen by the listener
+        self.prompts_lock = threading.Lock()
+        self.active_jobs = 0
+        self.recent_models = OrderedDict() # Checkpoints this backend ran recently, most recent last
+        self.startup_timeline = {} # Seconds from spawn to each startup milestone: process_spawn, http_up, ws_up, warmup_done
+
+    @property
+    def queue_depth(self): # Prompts this worker has queued on the backend that have not finished yet
+        with self.prompts_lock:
+            return len(self.prompts)
+
+    def load(self):
+        return self.queue_depth + self.active_jobs
+
+    def is_process_alive(self):
+        return self._process is not None and self._process.poll() is None
     
-    def start_api(self): # This method is used to start the API server
-        if not self.is_api_running(): # Block execution until the API server is running
-            aws_connector = AWSConnector()
-            api_command_line = API_COMMAND_LINE + f" --port {self.urlport}" # Add the port to the command line
-            if self._process is None or self._process.poll() is not None: # Check if the process is not running or has terminated for some reason
-                self._process = subprocess.Popen(api_command_line.split())
-                print("API process started with PID:", self._process.pid)
-                aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, f"API startup procedure began with PID: {self._process.pid} in port {self.urlport}", level='INFO')
+    def start_api(self): # This method is used to start the API server: spawn, wait for HTTP, connect the WebSocket, then run one optional warm-up generation
+        aws_connector = AWSConnector()
+        if self._process is None or self._process.poll() is not None: # Check if the process is not running or has terminated for some reason
+            start_time = time.time()
+            self.startup_timeline = {}
+            api_command_line = API_COMMAND_LINE + f" {self.extra_args} --port {self.urlport}" # Add the backend's own arguments and port to the command line
+            self._process = subprocess.Popen(api_command_line.split())
+            self.startup_timeline['process_spawn'] = time.time() - start_time
+            print(f"API process {self.index} started with PID:", self._process.pid)
+            aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, f"API startup procedure began with PID: {self._process.pid} in port {self.urlport}", level='INFO')
+            try: # A backend that fails to come up is killed, so the supervisor starts it afresh instead of leaving a live but unhealthy process
                 attempts = 0
-                while not self.is_api_running(): # Block execution until the API server is running
-                    if attempts >= MAX_COMFY_START_ATTEMPTS:
+                delay = COMFY_PROBE_INITIAL_DELAY
+                while not self.is_api_running(): # Cheap liveness polling with exponential backoff
+                    if self._process.poll() is not None:
+                        aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, f"API process exited with code {self._process.returncode} during startup.", level='ERROR')
+                        raise RuntimeError(f"API process exited with code {self._process.returncode} during startup.")
+                    if time.time() - start_time >= COMFY_START_TIMEOUT:
                         aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, f"API startup procedure failed after {attempts} attempts.", level='ERROR')
-                        raise RuntimeError("API startup procedure failed after {attempts} attempts.")
-                    time.sleep(1)  # Wait for 1 second before checking again
+                        raise RuntimeError(f"API startup procedure failed after {attempts} attempts.")
+                    time.sleep(delay)
+                    delay = min(delay * 2, COMFY_PROBE_MAX_DELAY)
                     attempts += 1 # Increment the number of attempts
-                aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, f"API startup procedure finalized after {attempts} attempts with PID: {self._process.pid} in port {self.urlport}", level='INFO')
-                print(f"API startup procedure finalized after {attempts} attempts with PID {self._process.pid} in port {self.urlport}")
-                time.sleep(0.5)  # Wait for 0.5 seconds before returning
+                self.startup_timeline['http_up'] = time.time() - start_time
+                self.connect_ws()
+                self.startup_timeline['ws_up'] = time.time() - start_time
+                if COMFY_WARMUP and TEST_PAYLOAD is not None:
+                    self.warm_up()
+                    self.startup_timeline['warmup_done'] = time.time() - start_time
+            except Exception:
+                self.kill_api()
+                raise
+            self.healthy = True
+            aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, f"API startup procedure finalized after {attempts} attempts with PID: {self._process.pid} in port {self.urlport}. Startup timeline (seconds): {json.dumps(self.startup_timeline)}", level='INFO')
+            print(f"API startup procedure finalized after {attempts} attempts with PID {self._process.pid} in port {self.urlport}. Startup timeline (seconds): {self.startup_timeline}")
 
-    def is_api_running(self): # This method is used to check if the API server is running
-        test_payload = TEST_PAYLOAD
+    def is_api_running(self): # This method is used to check if the API server is running; a single cheap request, no generation
         try:
-            print(f"Checking web server is running in {self.server_address}...")
-            response = requests.get(self.server_address)
-            if response.status_code == 200: # Check if the API server tells us it's running by returning a 200 status code
-                self.ws.connect(self.ws_address)
-                print(f"Web server is running (status code 200). Now trying test image...")
-                test_image = self.generate_images(test_payload)
-                print(f"Type of test_image: {type(test_image)}")
-                print(f"Test image: {test_image}")
-                if test_image is not None:  # this ensures that the API server is actually running and not just the web server
-                    return True
-                return False
-        except Exception as e:
-            print("API not running:", e)
+            response = self.session.get(f"{self.server_address}/system_stats", timeout=COMFY_PROBE_TIMEOUT)
+            return response.status_code == 200
+        except requests.RequestException:
             return False
 
-    def kill_api(self): # This method is used to kill the API server
+    def warm_up(self): # Runs TEST_PAYLOAD once so its checkpoint is loaded in memory before the first real job
+        ModelCache().ensure_models(find_workflow_models(TEST_PAYLOAD)) # The warm-up checkpoint must be on local disk first
+        test_image = self.generate_images(TEST_PAYLOAD)
+        if test_image is None:
+            raise RuntimeError("API warm-up generation failed.")
+
+    def kill_api(self): # This method is used to kill the API server; the supervisor restarts it
+        self.healthy = False
         if self._process is not None and self._process.poll() is None:
             aws_connector = AWSConnector()
             self._process.kill()
-            self._process = None
-            aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, f"API process killed.", level='INFO')
-            print("API process killed")
+            self._process.wait()
+            aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, f"API process in port {self.urlport} killed.", level='INFO')
+            print(f"API process in port {self.urlport} killed")
+        self.fail_pending_prompts(f"API process in port {self.urlport} was killed")
+
+    def connect_ws(self): # Opens a fresh WebSocket and hands it to a new listener thread; a listener exits once its socket is replaced
+        ws = WebSocket()
+        ws.connect(self.ws_address)
+        ws.settimeout(COMFY_WS_IDLE_TIMEOUT) # recv wakes up periodically so missed completions can be recovered from /history
+        self.ws = ws
+        threading.Thread(target=self.listen, args=(ws,), name=f'distillery-ws-{self.index}', daemon=True).start()
+
+    def listen(self, ws): # Runs in the listener thread: the only reader of the WebSocket, it demultiplexes events to the prompts they belong to
+        while self.ws is ws:
+            try:
+                opcode, data = ws.recv_data() # Raw frame: binary previews are recognised by opcode and never decoded
+                if opcode == ABNF.OPCODE_CLOSE:
+                    raise ConnectionError("server closed the connection")
+            except WebSocketTimeoutException: # Quiet connection: make sure no completion was missed
+                self.replay_pending_prompts()
+                continue
+            except Exception as e:
+                if self.ws is not ws or not self.is_process_alive():
+                    return
+                print(f"WebSocket to port {self.urlport} dropped ({e}). Reconnecting...")
+                time.sleep(COMFY_PROBE_MAX_DELAY)
+                try:
+                    self.connect_ws()
+                except Exception as e:
+                    print(f"Could not reconnect WebSocket to port {self.urlport}: {e}")
+                    continue
+                self.replay_pending_prompts() # Events sent while we were disconnected are lost; /history has the completions
+                return
+            if opcode == ABNF.OPCODE_BINARY:
+                if COMFY_FORWARD_PREVIEWS and self.executing_prompt_id is not None:
+                    self.route_event(self.executing_prompt_id, 'preview', data[8:]) # 4-byte event type + 4-byte image format precede the image
+                continue
+            if opcode != ABNF.OPCODE_TEXT:
+                continue
+            try:
+                self.route_message(json.loads(data))
+            except Exception as e:
+                print(f"Could not route WebSocket message from port {self.urlport}: {e}")
+
+    def route_message(self, message): # Dispatches one JSON event from ComfyUI
+        message_type = message.get('type')
+        data = message.get('data') or {}
+        prompt_id = data.get('prompt_id')
+        if message_type == 'execution_start':
+            self.executing_prompt_id = prompt_id
+            with self.prompts_lock:
+                tracker = self.prompts.get(prompt_id)
+                if tracker is not None:
+                    tracker.started_at = time.time()
+                elif prompt_id is not None: # An idle server starts the prompt before /prompt has answered
+                    now = time.time()
+                    self.unclaimed_starts = {pending_id: started for pending_id, started in self.unclaimed_starts.items() if now - started < COMFY_HTTP_TIMEOUT}
+                    self.unclaimed_starts[prompt_id] = now
+        elif message_type == 'executing':
+            if data.get('node') is None: # The prompt is done and its /history entry written; execution_success comes earlier, from inside execute(), so it is not a completion
+                if self.executing_prompt_id == prompt_id:
+                    self.executing_prompt_id = None
+                self.finish_prompt(prompt_id)
+            else:
+                self.executing_prompt_id = prompt_id
+                self.route_event(prompt_id, message_type, data)
+        elif message_type == 'execution_error':
+            self.finish_prompt(prompt_id, f"{data.get('node_type')} (node {data.get('node_id')}): {data.get('exception_type')}: {data.get('exception_message')}")
+        elif message_type == 'execution_interrupted':
+            self.finish_prompt(prompt_id, f"Interrupted at node {data.get('node_id')}")
+        elif message_type == 'execution_cached':
+            self.route_event(prompt_id, message_type, data)
+        elif message_type in ('progress', 'executed'):
+            self.route_event(prompt_id or self.executing_prompt_id, message_type, data) # Older servers send progress without a prompt_id; it belongs to the running prompt
+
+    def get_tracker(self, prompt_id):
+        with self.prompts_lock:
+            return self.prompts.get(prompt_id)
+
+    def route_event(self, prompt_id, event_type, data):
+        tracker = self.get_tracker(prompt_id)
+        if tracker is not None:
+            tracker.emit(event_type, data)
+
+    def replay_pending_prompts(self): # Finishes pending prompts that /history reports as completed
+        with self.prompts_lock:
+            pending_ids = list(self.prompts)
+        for prompt_id in pending_ids:
+            try:
+                history = self.get_history(prompt_id).get(prompt_id)
+            except Exception as e:
+                print(f"Could not replay prompt {prompt_id} from history: {e}")
+                continue
+            if history is None: # Still queued or running
+                continue
+            status = history.get('status', {})
+            if status.get('status_str') == 'error':
+                self.finish_prompt(prompt_id, f"Execution failed: {status.get('messages')}")
+            elif status.get('completed', True):
+                self.finish_prompt(prompt_id)
+
+    def track_prompt(self, prompt_id, on_event=None, slot=None, queued_at=None): # Registers a queued prompt; it may already have started, or even finished if it was quick
+        with self.prompts_lock:
+            tracker = PromptTracker(prompt_id, on_event, slot, queued_at)
+            tracker.started_at = self.unclaimed_starts.pop(prompt_id, None)
+            unclaimed = self.unclaimed_prompts.pop(prompt_id, None)
+            if unclaimed is not None:
+                tracker.finish(unclaimed[1])
+                tracker.finished_at = unclaimed[0]
+            else:
+                self.prompts[prompt_id] = tracker
+            return tracker
+
+    def finish_prompt(self, prompt_id, error=None):
+        if prompt_id is None:
+            return
+        with self.prompts_lock:
+            tracker = self.prompts.pop(prompt_id, None)
+            if tracker is None:
+                now = time.time()
+                self.unclaimed_prompts = {pending_id: entry for pending_id, entry in self.unclaimed_prompts.items() if now - entry[0] < COMFY_HTTP_TIMEOUT} # Forget completions nobody claimed
+                self.unclaimed_prompts.setdefault(prompt_id, (now, error)) # The first outcome wins; an error is followed by an 'executing' None
+                return
+        tracker.finish(error)
+
+    def forget_prompt(self, prompt_id, error): # Stops tracking a prompt nobody waits for any more and frees its queue slot
+        with self.prompts_lock:
+            tracker = self.prompts.pop(prompt_id, None)
+        if tracker is not None:
+            tracker.finish(error)
+
+    def cancel_prompts(self, trackers, reason): # Removes a job's unfinished prompts from ComfyUI: queued ones are deleted and the running one is interrupted if it is the job's
+        pending = [tracker for tracker in trackers if not tracker.done.is_set()]
+        if not pending:
+            return
+        prompt_ids = [tracker.prompt_id for tracker in pending]
+        try:
+            self.session.post(f"{self.server_address}/queue", json={"delete": prompt_ids}, timeout=COMFY_HTTP_TIMEOUT) # Delete first, or ComfyUI starts the next one after the interrupt
+            executing_prompt_id = self.executing_prompt_id
+            if executing_prompt_id in prompt_ids: # /interrupt stops whatever is running, so it is only sent for the job's own prompt; newer servers also check the prompt_id
+                self.session.post(f"{self.server_address}/interrupt", json={"prompt_id": executing_prompt_id}, timeout=COMFY_HTTP_TIMEOUT)
+        except requests.RequestException as e:
+            print(f"Could not cancel prompts {prompt_ids} on port {self.urlport}: {e}")
+        for tracker in pending:
+            self.forget_prompt(tracker.prompt_id, reason) # Wakes the job and frees the queue slots right away
+        AWSConnector().print_log('N/A', INSTANCE_IDENTIFIER, f"Cancelled {len(pending)} prompts on port {self.urlport}: {reason}", level='INFO')
+
+    def fail_pending_prompts(self, error):
+        with self.prompts_lock:
+            trackers = list(self.prompts.values())
+            self.prompts.clear()
+        for tracker in trackers:
+            tracker.finish(error)
 
     def get_history(self, prompt_id): # This method is used to retrieve the history of a prompt from the API server
-        with urllib.request.urlopen(f"{self.server_address}/history/{prompt_id}") as response:
-            return json.loads(response.read())
+        response = self.session.get(f"{self.server_address}/history/{prompt_id}", timeout=COMFY_HTTP_TIMEOUT)
+        response.raise_for_status()
+        return response.json()
 
-    def get_image(self, filename, subfolder, folder_type): # This method is used to retrieve an image from the API server
+    def get_image(self, filename, subfolder, folder_type): # This method is used to retrieve an image: straight from disk in local output mode, from the API server otherwise
+        if COMFY_OUTPUT_FOLDER and folder_type == 'output':
+            image_data = self.read_local_output(filename, subfolder)
+            if image_data is not None:
+                return image_data
         data = {"filename": filename, "subfolder": subfolder, "type": folder_type}
-        url_values = urllib.parse.urlencode(data)
-        with urllib.request.urlopen(f"{self.server_address}/view?{url_values}") as response:
-            return response.read()
+        response = self.session.get(f"{self.server_address}/view", params=data, timeout=COMFY_HTTP_TIMEOUT)
+        response.raise_for_status()
+        return response.content
 
-    def queue_prompt(self, prompt): # This method is used to queue a prompt for execution
-        p = {"prompt": prompt, "client_id": self.client_id}
-        data = json.dumps(p).encode('utf-8')
-        headers = {'Content-Type': 'application/json'}  # Set Content-Type header
-        req = urllib.request.Request(f"{self.server_address}/prompt", data=data, headers=headers)
-        return json.loads(urllib.request.urlopen(req).read())
+    @staticmethod
+    def read_local_output(filename, subfolder): # Maps a finished output file into memory and returns a zero-copy memoryview over it, or None to fall back to HTTP
+        output_root = os.path.realpath(COMFY_OUTPUT_FOLDER)
+        path = os.path.realpath(os.path.join(output_root, subfolder or '', filename))
+        if not path.startswith(output_root + os.sep): # Never follow a name outside the output folder
+            return None
+        try:
+            with open(path, 'rb') as file:
+                return memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)) # The mapping outlives the file handle and is released with the last view
+        except (OSError, ValueError) as e: # Missing file, different filesystem, or empty file
+            print(f"Could not read {path} locally, falling back to HTTP: {e}")
+            return None
 
-    def generate_images(self, payload): # This method is used to generate images from a prompt and is the main method of this class
+    def queue_prompt(self, prompt, on_event=None, blocking=True, cancel=None): # This method is used to queue a prompt for execution; returns its tracker, or None if blocking is False and the worker-wide prompt queue is full
+        if blocking and cancel is not None:
+            cancel.acquire(self.prompt_slots) # Gives up if the job is cancelled while the queue is full
+        elif not self.prompt_slots.acquire(blocking=blocking):
+            return None
         try:
-            if not self.ws.connected: # Check if the WebSocket is connected to the API server and reconnect if necessary
-                print("WebSocket is not connected. Reconnecting...")
-                self.ws.connect(self.ws_address)
-            prompt_id = self.queue_prompt(payload)['prompt_id']
-            while True:
-                out = self.ws.recv() # Wait for a message from the API server
-                if isinstance(out, str): # Check if the message is a string
-                    message = json.loads(out) # Parse the message as JSON
-                    if message['type'] == 'executing': # Check if the message is an 'executing' message
-                        data = message['data'] # Extract the data from the message
-                        if data['node'] is None and data['prompt_id'] == prompt_id:
-                            break
-            address = self.find_output_node(payload) # Find the SaveImage node; workflow MUST contain only one SaveImage node
+            queued_at = time.time()
+            p = {"prompt": prompt, "client_id": self.client_id}
+            response = self.session.post(f"{self.server_address}/prompt", json=p, timeout=COMFY_HTTP_TIMEOUT)
+            if response.status_code != 200: # ComfyUI explains validation errors in the body
+                raise RuntimeError(f"Prompt rejected by the API server with status {response.status_code}: {response.text}")
+            return self.track_prompt(response.json()['prompt_id'], on_event, self.prompt_slots, queued_at) # The slot now belongs to the tracker
+        except Exception:
+            self.prompt_slots.release()
+            raise
+
+    def wait_for_prompts(self, trackers): # This method yields each tracker, in submission order, as soon as its prompt has finished executing
+        for tracker in trackers: # Prompts may finish out of order; waiting in order keeps results in submission order
+            if not tracker.wait(COMFY_PROMPT_TIMEOUT or None): # Per-prompt budget counts from when the previous prompt finished, so queueing behind it is not charged
+                self.forget_prompt(tracker.prompt_id, "Timed out")
+                raise TimeoutError(f"Prompt {tracker.prompt_id} did not finish in time on port {self.urlport}")
+            if tracker.error is not None:
+                raise RuntimeError(f"Prompt {tracker.prompt_id} failed: {tracker.error}")
+            yield tracker
+
+    def get_output_images(self, prompt_id, template, trace=None): # This method is used to retrieve the files written by every saver node of a finished prompt
+        trace = trace or JobTrace() # Untraced callers record into a throwaway trace
+        with trace.stage('history_fetch'):
             history = self.get_history(prompt_id)[prompt_id]
-            filenames = eval(f"history['outputs']{address}")['images']  # Extract all images
-            images = []
-            for img_info in filenames:
+        images = []
+        with trace.stage('image_download'):
+            for img_info in template.output_files(history):
                 filename = img_info['filename']
                 subfolder = img_info['subfolder']
                 folder_type = img_info['type']
-                image_data = self.get_image(filename, subfolder, folder_type)
-                image_file = io.BytesIO(image_data)
-                image = Image.open(image_file)
-                images.append(image)
-            return images
+                image_data = self.get_image(filename, subfolder, folder_type) # Raw file bytes; they are not decoded so metadata can be spliced without re-encoding
+                images.append(image_data)
+        return images
+
+    def remember_models(self, models): # Records the checkpoints a job used here, for model-affine scheduling
+        for folder, model_name in models:
+            if folder in ('checkpoints', 'unet'):
+                self.recent_models.pop(model_name, None)
+                self.recent_models[model_name] = True
+                while len(self.recent_models) > RECENT_MODELS_PER_BACKEND:
+                    self.recent_models.popitem(last=False)
+
+    def generate_images(self, payload): # This method is used to generate images from a prompt and is the main method of this class
+        try:
+            tracker = self.queue_prompt(payload)
+            for tracker in self.wait_for_prompts([tracker]):
+                return self.get_output_images(tracker.prompt_id, TemplateCache().get(payload))
         except Exception as e:
             aws_connector = AWSConnector()
             exc_type, exc_value, exc_traceback = sys.exc_info()
@@ -151,11 +426,55 @@ class ComfyConnector:
             print("generate_images - ", error_message)
             aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, error_message, level='ERROR')
 
+    def generate_images_pipelined(self, payloads, template, on_event=None, cancel=None, trace=None): # This method keeps as many payloads (variants of one compiled template) queued as MAX_QUEUED_PROMPTS allows and yields the images of each one, in order, as soon as it is done; on_event(index, event_type, data) receives the live events of each payload; cancelling the CancelToken removes the job's prompts from ComfyUI
+        trackers = []
+        def queue_next(blocking): # Queues the next payload; without blocking, only if the worker-wide prompt queue has room
+            index = len(trackers)
+            if index == len(payloads):
+                return False
+            callback = (lambda event_type, data: on_event(index, event_type, data)) if on_event is not None else None
+            tracker = self.queue_prompt(payloads[index], callback, blocking, cancel)
+            if tracker is None:
+                return False
+            trackers.append(tracker)
+            if cancel is not None:
+                cancel.raise_if_cancelled() # Cancelled while this prompt was being queued; the finally below removes it
+            return True
+        unregister = cancel.on_cancel(lambda: self.cancel_prompts(list(trackers), cancel.reason)) if cancel is not None else None
+        try:
+            for index in range(len(payloads)):
+                while len(trackers) <= index: # This payload must be queued before we can wait for it
+                    queue_next(blocking=True)
+                while queue_next(blocking=False): # Fill the ComfyUI queue as far as MAX_QUEUED_PROMPTS allows so the GPU never waits on post-processing
+                    pass
+                for tracker in self.wait_for_prompts([trackers[index]]):
+                    if trace is not None:
+                        started_at = tracker.started_at or tracker.queued_at # Missing when the prompt was fully cached or only seen through /history
+                        trace.add('queue_wait', started_at - tracker.queued_at)
+                        trace.add('sampling', tracker.finished_at - started_at)
+                    yield self.get_output_images(tracker.prompt_id, template, trace) # The caller post-processes these while the next prompt is sampling
+        except JobCancelled:
+            raise
+        except Exception as e:
+            if cancel is not None:
+                cancel.raise_if_cancelled() # The prompt failed because the job was cancelled; that is not an error of this backend
+            aws_connector = AWSConnector()
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            line_no = exc_traceback.tb_lineno
+            error_message = f'Unhandled error at line {line_no}: {str(e)}'
+            print("generate_images_pipelined - ", error_message)
+            aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, error_message, level='ERROR')
+            raise RuntimeError(f"An error occurred while generating pipelined images in line {line_no}: {str(e)}")
+        finally:
+            if unregister is not None:
+                unregister()
+            self.cancel_prompts(trackers, cancel.reason if cancel is not None and cancel.cancelled else "Job stopped early") # A failed or abandoned job must not leave its remaining seeds in the queue
 
-    def upload_image(self, filepath, subfolder=None, folder_type=None, overwrite=False): # This method is used to upload an image to the API server for use in img2img or controlnet
+    def upload_image(self, file_obj, filename, subfolder=None, folder_type=None, overwrite=False): # This method is used to upload an in-memory image to the API server for use in img2img or controlnet; the buffer is streamed as the multipart body
         try: 
             url = f"{self.server_address}/upload/image"
-            files = {'image': open(filepath, 'rb')}
+            file_obj.seek(0)
+            files = {'image': (filename, file_obj)}
             data = {
                 'overwrite': str(overwrite).lower()
             }
@@ -163,7 +482,8 @@ class ComfyConnector:
                 data['subfolder'] = subfolder
             if folder_type:
                 data['type'] = folder_type
-            response = requests.post(url, files=files, data=data)
+            response = self.session.post(url, files=files, data=data, timeout=COMFY_HTTP_TIMEOUT)
+            response.raise_for_status()
             return response.json()
         except Exception as e:
             aws_connector = AWSConnector()
@@ -172,31 +492,57 @@ class ComfyConnector:
             error_message = f'Unhandled error at line {line_no}: {str(e)}'
             aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, error_message, level='ERROR')
 
-    @staticmethod
-    def find_output_node(json_object): # This method is used to find the node containing the SaveImage class in a prompt
-        for key, value in json_object.items():
-            if isinstance(value, dict):
-                if value.get("class_type") == "SaveImage":
-                    return f"['{key}']"  # Return the key containing the SaveImage class
-                result = ComfyConnector.find_output_node(value)
-                if result:
-                    return result
-        return None
-    
     @staticmethod
     def load_payload(path):
         with open(path, 'r') as file:
             return json.load(file)
 
-    def upload_from_s3_to_input(self, aws_connector, s3_keys: List[str]):
+    def upload_input(self, s3_key, etag, file_obj, cancel=None): # Uploads one downloaded input unless ComfyUI already holds identical content; returns the upload response, whose 'name' the workflow must read
+        if cancel is not None:
+            cancel.raise_if_cancelled() # Uploads still waiting for a thread are skipped
+        filename = input_filename(s3_key, hashlib.sha256(file_obj.getbuffer()).hexdigest())
+        with self.input_cache.lock:
+            already_uploaded = filename in self.input_cache.uploaded
+        response = {"name": filename} if already_uploaded else self.upload_image(file_obj, filename, folder_type='input', overwrite=True) # overwrite, or ComfyUI renames the file; same name means same content, so nothing is lost
+        if response is not None:
+            with self.input_cache.lock:
+                self.input_cache.entries[s3_key] = {'etag': etag, 'name': filename}
+                self.input_cache.uploaded.add(filename)
+        return response
+
+    def upload_from_s3_to_input(self, aws_connector, s3_keys: List[str], cancel=None, trace=None): # Transfers all inputs of a job concurrently, skipping the ones ComfyUI already has, and returns {S3 key: input file name}; stops between steps once cancel is cancelled
+        trace = trace or JobTrace() # Untraced callers record into a throwaway trace
         try:
-            file_objs = aws_connector.download_fileobj(s3_keys) # Download file objects from AWS S3
-            for s3_key, file_obj in zip(s3_keys, file_objs): # Iterate through the downloaded file objects and corresponding S3 keys
-                temp_file_path = os.path.join(tempfile.gettempdir(), os.path.basename(s3_key)) # Create a temporary file with the same name as the S3 key
-                with open(temp_file_path, 'wb') as temp_file:
-                    temp_file.write(file_obj.read())
-                response = self.upload_image(filepath=temp_file_path, folder_type='input') # Upload the temporary file to the Comfy API in the 'input' folder
-                os.unlink(temp_file_path) # Delete the temporary file
+            s3_keys = list(dict.fromkeys(s3_keys)) # The same image may be used for several inputs
+            with trace.stage('input_download'):
+                head_results = aws_connector.head_objects(s3_keys) # ETags tell us whether a key changed since we last uploaded it
+            failed = [result.key for result in head_results if not result.success]
+            if failed:
+                raise RuntimeError(f"Could not find {failed} in S3")
+            with self.input_cache.lock:
+                names = {result.key: self.input_cache.current_name(result.key, result.etag) for result in head_results}
+                etags = {result.key: result.etag for result in head_results}
+            stale_keys = [s3_key for s3_key, name in names.items() if name is None]
+            if not stale_keys:
+                return names
+            if cancel is not None:
+                cancel.raise_if_cancelled()
+            with trace.stage('input_download'):
+                results = aws_connector.download_fileobj(stale_keys) # Download file objects from AWS S3, in parallel
+            failed = [result.key for result in results if not result.success]
+            if failed:
+                raise RuntimeError(f"Could not download {failed} from S3")
+            if cancel is not None:
+                cancel.raise_if_cancelled()
+            with trace.stage('comfy_upload'):
+                uploads = list(self.input_upload_pool.map(lambda result: self.upload_input(result.key, etags[result.key], result.file_obj, cancel), results)) # Stream every buffer straight into ComfyUI
+            failed = [s3_key for s3_key, response in zip(stale_keys, uploads) if response is None]
+            if failed:
+                raise RuntimeError(f"Could not upload {failed} to the Comfy API")
+            names.update((s3_key, response['name']) for s3_key, response in zip(stale_keys, uploads))
+            return names
+        except JobCancelled:
+            raise
         except Exception as e:
             aws_connector = AWSConnector()
             exc_type, exc_value, exc_traceback = sys.exc_info()
@@ -205,3 +551,108 @@ class ComfyConnector:
             aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, error_message, level='ERROR')
             raise RuntimeError(f"An error occurred while uploading from S3 to input: {str(e)}")
 
+class ComfyConnector: # Launches and supervises COMFY_BACKENDS ComfyUI processes and routes jobs to them
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __new__(cls, *args, **kwargs):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = super(ComfyConnector, cls).__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        with ComfyConnector._instance_lock: # Concurrent first jobs must not start the backends twice
+            if not hasattr(self, 'initialized'):
+                self.initialize()
+
+    def initialize(self):
+        self.backends = []
+        self.lock = threading.Condition()
+        self.prompt_slots = threading.BoundedSemaphore(MAX_QUEUED_PROMPTS)
+        shared_input_cache = InputCache()
+        port = INITIAL_PORT
+        for index in range(COMFY_BACKENDS):
+            port = self.find_available_port(port)
+            extra_args = COMFY_BACKEND_ARGS[index] if index < len(COMFY_BACKEND_ARGS) else ''
+            self.backends.append(ComfyBackend(index, port, extra_args, shared_input_cache if COMFY_BACKENDS_SHARE_INPUTS else InputCache(), self.prompt_slots))
+            port += 1
+        self.start_backends()
+        threading.Thread(target=self.supervise, name='distillery-comfy-supervisor', daemon=True).start()
+        MetricsRegistry().register_gauge('distillery_comfy_queue_depth', 'Prompts queued by this worker on each ComfyUI backend and not yet finished', 'port', self.queue_depths)
+        self.initialized = True
+
+    @staticmethod
+    def find_available_port(port=INITIAL_PORT): # If the port is already in use, this method finds the next available port to start an API server on
+        while True:
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock: # Binding is instant and, unlike an HTTP probe, also catches ports held by non-HTTP services
+                try:
+                    sock.bind((API_URL, port))
+                    return port
+                except OSError:
+                    port += 1
+
+    def start_backends(self): # Starts every backend in parallel; the worker can run as long as one of them comes up
+        errors = {}
+        def start(backend):
+            try:
+                backend.start_api()
+            except Exception as e:
+                errors[backend.urlport] = str(e)
+        threads = [threading.Thread(target=start, args=(backend,)) for backend in self.backends]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if len(errors) == len(self.backends):
+            raise RuntimeError(f"No API server could be started: {errors}")
+        if errors:
+            AWSConnector().print_log('N/A', INSTANCE_IDENTIFIER, f"Some API servers failed to start and will be retried by the supervisor: {errors}", level='WARNING')
+
+    def supervise(self): # Runs in the supervisor thread: restarts backends whose process died, and backends left running but unhealthy
+        while True:
+            time.sleep(COMFY_SUPERVISE_INTERVAL)
+            for backend in self.backends:
+                if backend.healthy and backend.is_process_alive():
+                    continue
+                try:
+                    aws_connector = AWSConnector()
+                    if backend.is_process_alive(): # start_api only spawns a process when none is running
+                        aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, f"API process in port {backend.urlport} is running but unhealthy; restarting it.", level='WARNING')
+                        backend.kill_api()
+                    else:
+                        exit_code = backend._process.returncode if backend._process is not None else None
+                        aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, f"API process in port {backend.urlport} is not running (exit code {exit_code}); restarting it.", level='WARNING')
+                        backend.healthy = False
+                        backend.fail_pending_prompts(f"API process in port {backend.urlport} exited with code {exit_code}")
+                    backend.start_api()
+                    with self.lock:
+                        self.lock.notify_all()
+                except Exception as e:
+                    print(f"Could not restart API process in port {backend.urlport}: {e}")
+
+    def queue_depths(self): # Per-backend number of prompts this worker has queued and not yet seen finish
+        return {backend.urlport: backend.queue_depth for backend in self.backends}
+
+    def acquire_backend(self, models=()): # Picks the least loaded healthy backend, preferring one that recently ran the job's checkpoint; pair with release_backend
+        checkpoints = {model_name for folder, model_name in models if folder in ('checkpoints', 'unet')}
+        deadline = time.time() + COMFY_START_TIMEOUT
+        with self.lock:
+            while True:
+                candidates = [backend for backend in self.backends if backend.healthy]
+                if candidates:
+                    break
+                if time.time() >= deadline:
+                    raise RuntimeError("No healthy API server available.")
+                self.lock.wait(timeout=COMFY_SUPERVISE_INTERVAL) # Woken up when the supervisor brings a backend back
+            def score(backend):
+                affine = bool(checkpoints) and checkpoints.issubset(backend.recent_models)
+                return (backend.load() - (COMFY_AFFINITY_SLACK if affine else 0), backend.index)
+            backend = min(candidates, key=score)
+            backend.active_jobs += 1
+            backend.remember_models(models)
+            return backend
+
+    def release_backend(self, backend):
+        with self.lock:
+            backend.active_jobs -= 1
@@ -0,0 +1,147 @@
+#### Distillery Metrics - Per-stage job timings, exported as CloudWatch Embedded Metric Format and optionally as Prometheus text
+
+import os
+import time
+import atexit
+import threading
+from contextlib import contextmanager
+from collections import defaultdict, deque, Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from distillery_aws import AWSConnector
+
+APP_NAME = os.getenv('APP_NAME') # Name of the application
+METRICS_NAMESPACE = os.getenv('METRICS_NAMESPACE', 'Distillery') # CloudWatch namespace of the stage metrics
+METRICS_EMF = os.getenv('METRICS_EMF', 'true').lower() == 'true' # Whether stage timings are shipped to CloudWatch as Embedded Metric Format records
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '60')) # Seconds between EMF records; every job in between is included, so CloudWatch computes exact percentiles
+METRICS_WINDOW = int(os.getenv('METRICS_WINDOW', '1000')) # Most recent jobs per stage used for the quantiles of the Prometheus endpoint
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0')) # Port of the local Prometheus text endpoint (/metrics); 0 disables it
+STAGES = ('staging_wait', 'input_download', 'comfy_upload', 'model_staging', 'queue_wait', 'sampling', 'history_fetch', 'image_download', 'encode', 's3_upload', 'total') # In pipeline order; 'total' is the job's wall-clock time
+QUANTILES = (0.5, 0.9, 0.95, 0.99)
+EMF_MAX_VALUES = 100 # CloudWatch accepts at most 100 values per metric in one EMF record
+
+def quantile(sorted_values, q): # Nearest-rank quantile of an already sorted list
+    return sorted_values[min(int(q * len(sorted_values)), len(sorted_values) - 1)]
+
+class JobTrace: # Seconds spent by one job in each stage; stages that run once per image or prompt add up, and stages that overlap (uploads during sampling) can add up to more than the total
+    def __init__(self):
+        self.start = time.time()
+        self.stages = defaultdict(float)
+        self.lock = threading.Lock() # Upload threads record into the trace of their job
+
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.stages[name] += seconds
+
+    def as_dict(self): # Stage -> seconds, in pipeline order, plus the total so far
+        with self.lock:
+            stages = {name: round(self.stages[name], 4) for name in STAGES if name in self.stages}
+        stages['total'] = round(time.time() - self.start, 4)
+        return stages
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = MetricsRegistry().prometheus_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): # Scrapes are not worth a log line each
+        pass
+
+class MetricsRegistry:
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __new__(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                instance = super().__new__(cls)
+                instance.lock = threading.Lock()
+                instance.recent = defaultdict(lambda: deque(maxlen=METRICS_WINDOW)) # Stage -> seconds of the last METRICS_WINDOW jobs
+                instance.pending = defaultdict(list) # Stage -> milliseconds not yet shipped as EMF
+                instance.sums = defaultdict(float)
+                instance.counts = Counter()
+                instance.jobs = Counter() # Status -> jobs finished
+                instance.gauges = {} # Metric name -> (help text, label name, callback returning {label value: number}), read at scrape time
+                if METRICS_EMF:
+                    threading.Thread(target=instance.flush_loop, name='distillery-metrics', daemon=True).start()
+                    atexit.register(instance.flush_emf)
+                if METRICS_PORT:
+                    server = ThreadingHTTPServer(('0.0.0.0', METRICS_PORT), MetricsHandler)
+                    server.daemon_threads = True
+                    threading.Thread(target=server.serve_forever, name='distillery-metrics-http', daemon=True).start()
+                cls._instance = instance
+        return cls._instance
+
+    def record(self, stages, status): # Adds one finished job; status is 'succeeded', 'failed' or 'cancelled'
+        with self.lock:
+            self.jobs[status] += 1
+            for name, seconds in stages.items():
+                self.recent[name].append(seconds)
+                self.pending[name].append(round(seconds * 1000, 1))
+                self.sums[name] += seconds
+                self.counts[name] += 1
+
+    def register_gauge(self, name, help_text, label, callback): # Exposes a value owned by another module on /metrics without this module importing it
+        with self.lock:
+            self.gauges[name] = (help_text, label, callback)
+
+    def flush_loop(self): # Runs in the background metrics thread
+        while True:
+            time.sleep(METRICS_FLUSH_INTERVAL)
+            try:
+                self.flush_emf()
+            except Exception as e:
+                print(f"Error flushing metrics: {e}")
+
+    def flush_emf(self): # Ships every timing recorded since the last flush, in as many records as the 100-values limit requires
+        with self.lock:
+            pending, self.pending = self.pending, defaultdict(list)
+            jobs = dict(self.jobs)
+        if not pending:
+            return
+        aws_connector = AWSConnector()
+        for offset in range(0, max(len(values) for values in pending.values()), EMF_MAX_VALUES):
+            chunk = {name: values[offset:offset + EMF_MAX_VALUES] for name, values in pending.items() if values[offset:offset + EMF_MAX_VALUES]}
+            record = {
+                "_aws": {
+                    "Timestamp": int(time.time() * 1000),
+                    "CloudWatchMetrics": [{"Namespace": METRICS_NAMESPACE, "Dimensions": [["Service"]], "Metrics": [{"Name": name, "Unit": "Milliseconds"} for name in chunk]}]
+                },
+                "Service": APP_NAME,
+                "JobsByStatus": jobs, # Not a metric; kept in the record for Logs Insights
+                **chunk
+            }
+            aws_connector.emit_metrics(record)
+
+    def prometheus_text(self): # Summary per stage over the last METRICS_WINDOW jobs, plus job counters and registered gauges
+        lines = ["# HELP distillery_stage_seconds Seconds a job spent in each stage", "# TYPE distillery_stage_seconds summary"]
+        with self.lock:
+            for name in STAGES:
+                if not self.counts[name]:
+                    continue
+                recent = sorted(self.recent[name])
+                for q in QUANTILES:
+                    lines.append(f'distillery_stage_seconds{{stage="{name}",quantile="{q}"}} {quantile(recent, q):.6f}')
+                lines.append(f'distillery_stage_seconds_sum{{stage="{name}"}} {self.sums[name]:.6f}')
+                lines.append(f'distillery_stage_seconds_count{{stage="{name}"}} {self.counts[name]}')
+            lines += ["# HELP distillery_jobs_total Jobs finished by this worker", "# TYPE distillery_jobs_total counter"]
+            lines += [f'distillery_jobs_total{{status="{status}"}} {count}' for status, count in sorted(self.jobs.items())]
+            gauges = dict(self.gauges)
+        for name, (help_text, label, callback) in sorted(gauges.items()): # Outside the lock, as callbacks take their owners' locks
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+            lines += [f'{name}{{{label}="{key}"}} {value}' for key, value in sorted(callback().items())]
+        return "\n".join(lines) + "\n"
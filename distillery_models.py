@@ -0,0 +1,275 @@
+#### Distillery Model Cache - Disk-budgeted LRU cache of models copied from network storage into ComfyUI's models folder
+
+import os
+import sys
+import json
+import time
+import uuid
+import errno
+import shutil
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, Future
+from distillery_aws import AWSConnector
+from distillery_cancel import JobCancelled
+
+APP_NAME = os.getenv('APP_NAME') # Name of the application
+NETWORK_STORAGE = os.getenv("NETWORK_STORAGE") # Path to network storage mount
+MODELS_FOLDER = os.getenv("MODELS_FOLDER") # Path to models folder in ComfyUI
+MODEL_CACHE_BUDGET_GB = float(os.getenv('MODEL_CACHE_BUDGET_GB', '0')) # Disk budget for models copied by the cache; 0 means only the free-space floor applies
+MODEL_CACHE_MIN_FREE_GB = float(os.getenv('MODEL_CACHE_MIN_FREE_GB', '5')) # Free disk space that must remain after a copy; older models are evicted to keep it
+MODEL_COPY_THREADS = int(os.getenv('MODEL_COPY_THREADS', '4')) # Number of models copied in parallel
+MODEL_COPY_CHUNK_MB = int(os.getenv('MODEL_COPY_CHUNK_MB', '64')) # Size of each kernel-side copy call
+MODEL_CACHE_INDEX = os.getenv('MODEL_CACHE_INDEX') or os.path.join(MODELS_FOLDER or '.', '.distillery_model_cache.json') # Persisted access index, survives worker restarts
+PARTIAL_SUFFIX = '.distillery-partial' # Suffix of in-progress copies; renamed away atomically once complete
+MODEL_LOADER_FOLDERS = { # Loader node class -> {input name: models folder}; used to find every model a workflow needs
+    "CheckpointLoaderSimple": {"ckpt_name": "checkpoints"},
+    "CheckpointLoader": {"ckpt_name": "checkpoints"},
+    "ImageOnlyCheckpointLoader": {"ckpt_name": "checkpoints"},
+    "unCLIPCheckpointLoader": {"ckpt_name": "checkpoints"},
+    "LoraLoader": {"lora_name": "loras"},
+    "LoraLoaderModelOnly": {"lora_name": "loras"},
+    "ControlNetLoader": {"control_net_name": "controlnet"},
+    "DiffControlNetLoader": {"control_net_name": "controlnet"},
+    "VAELoader": {"vae_name": "vae"},
+    "UpscaleModelLoader": {"model_name": "upscale_models"},
+    "CLIPLoader": {"clip_name": "clip"},
+    "DualCLIPLoader": {"clip_name1": "clip", "clip_name2": "clip"},
+    "CLIPVisionLoader": {"clip_name": "clip_vision"},
+    "UNETLoader": {"unet_name": "unet"},
+    "StyleModelLoader": {"style_model_name": "style_models"},
+    "GLIGENLoader": {"gligen_name": "gligen"},
+    "HypernetworkLoader": {"hypernetwork_name": "hypernetworks"},
+}
+MODEL_LOADER_FOLDERS.update(json.loads(os.getenv('MODEL_LOADER_MAP') or '{}')) # Extra or overridden loaders as JSON, e.g. '{"IPAdapterModelLoader": {"ipadapter_file": "ipadapter"}}'
+
+GB = 1024 ** 3
+
+def copy_file_chunked(source, destination, cancel_event=None): # Copies source to destination in kernel space where possible (copy_file_range, then sendfile, then plain read/write); stops between chunks once cancel_event is set
+    chunk_size = MODEL_COPY_CHUNK_MB * 1024 * 1024
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        size = os.fstat(src.fileno()).st_size
+        copied = 0
+        method = 'copy_file_range' if hasattr(os, 'copy_file_range') else 'sendfile'
+        while copied < size:
+            if cancel_event is not None and cancel_event.is_set():
+                raise JobCancelled(f"Copy of {source} abandoned after {copied} of {size} bytes")
+            count = min(chunk_size, size - copied)
+            try:
+                if method == 'copy_file_range':
+                    sent = os.copy_file_range(src.fileno(), dst.fileno(), count, copied, copied)
+                elif method == 'sendfile':
+                    sent = os.sendfile(dst.fileno(), src.fileno(), copied, count)
+                else:
+                    src.seek(copied)
+                    sent = dst.write(src.read(count))
+            except OSError as e:
+                if method != 'readwrite' and e.errno in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF):
+                    method = 'sendfile' if method == 'copy_file_range' else 'readwrite' # Filesystem does not support this path; fall back and retry the same chunk
+                    dst.seek(copied) # copy_file_range and sendfile take explicit source offsets, but sendfile and write put the data at the destination's file position, which copy_file_range never moved
+                    continue
+                raise
+            if sent == 0:
+                raise IOError(f"Unexpected end of file while copying {source} ({copied} of {size} bytes)")
+            copied += sent
+    return size
+
+def find_workflow_models(comfy_api): # Walks the prompt graph and returns the unique (folder, model_name) pairs referenced by loader nodes
+    models = []
+    for node in comfy_api.values():
+        if not isinstance(node, dict):
+            continue
+        inputs = node.get("inputs", {})
+        for input_name, folder in MODEL_LOADER_FOLDERS.get(node.get("class_type"), {}).items():
+            model_name = inputs.get(input_name)
+            if isinstance(model_name, str) and model_name and (folder, model_name) not in models: # Linked inputs are lists and are skipped
+                models.append((folder, model_name))
+    return models
+
+class ModelCache:
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __new__(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                instance = super().__new__(cls)
+                instance.lock = threading.Lock()
+                instance.in_flight = {} # Relative path -> Future of the copy in progress, so concurrent requests for one model share a single copy
+                instance.copy_waiters = {} # Relative path -> {"future", "waiters", "cancel"}; a copy is stopped once every job waiting for it is cancelled
+                instance.pinned = Counter() # Relative paths in use by running jobs; never evicted
+                instance.reserved_bytes = 0 # Space promised to copies in progress
+                instance.copy_pool = ThreadPoolExecutor(max_workers=MODEL_COPY_THREADS, thread_name_prefix='distillery-model-copy')
+                instance.index = instance.load_index()
+                instance.remove_partial_copies()
+                cls._instance = instance
+        return cls._instance
+
+    def load_index(self): # Loads the access index and drops entries whose files have disappeared
+        try:
+            with open(MODEL_CACHE_INDEX, 'r') as file:
+                index = json.load(file)
+        except (OSError, ValueError):
+            index = {}
+        return {rel_path: entry for rel_path, entry in index.items() if os.path.exists(os.path.join(MODELS_FOLDER, rel_path))}
+
+    def save_index(self): # Must be called with self.lock held; written to a temp file and renamed so a crash never leaves a torn index
+        temp_path = f"{MODEL_CACHE_INDEX}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(temp_path, 'w') as file:
+                json.dump(self.index, file)
+            os.replace(temp_path, MODEL_CACHE_INDEX)
+        except OSError as e:
+            print(f"Could not persist model cache index: {e}")
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+
+    def remove_partial_copies(self): # Deletes copies left half-written by a previous worker that died mid-copy
+        for root, _, files in os.walk(MODELS_FOLDER or '.'):
+            for name in files:
+                if name.endswith(PARTIAL_SUFFIX):
+                    try:
+                        os.unlink(os.path.join(root, name))
+                        print(f"Removed stale partial copy {os.path.join(root, name)}")
+                    except OSError:
+                        pass
+
+    def pin(self, models): # models is a list of (folder, model_name); pinned models are not evicted until unpinned
+        with self.lock:
+            for folder, model_name in models:
+                self.pinned[f"{folder}/{model_name}"] += 1
+
+    def unpin(self, models):
+        with self.lock:
+            for folder, model_name in models:
+                rel_path = f"{folder}/{model_name}"
+                self.pinned[rel_path] -= 1
+                if self.pinned[rel_path] <= 0:
+                    del self.pinned[rel_path]
+
+    def touch(self, rel_path, size, managed): # Must be called with self.lock held
+        entry = self.index.setdefault(rel_path, {"size": size, "managed": managed})
+        entry["last_access"] = time.time()
+        entry["managed"] = entry.get("managed", False) or managed
+
+    def ensure_models(self, models): # Makes every (folder, model_name) available locally, copying missing ones in parallel; returns one result dict per model, in order
+        return self.wait_for_models(models, self.start_models(models))
+
+    def start_models(self, models): # Starts the copies without waiting, so staging can overlap with other work; pass the futures to wait_for_models, then to release_copies
+        return [self.ensure_model(folder, model_name) for folder, model_name in models]
+
+    def release_copies(self, futures, abandon=False): # Drops a job's interest in the copies it started; with abandon, copies no other job waits for are stopped and their partial files removed
+        with self.lock:
+            for waiter in self.copy_waiters.values():
+                if any(waiter["future"] is future for future in futures):
+                    waiter["waiters"] -= 1
+                    if abandon and waiter["waiters"] <= 0:
+                        waiter["cancel"].set()
+
+    def wait_for_models(self, models, futures, cancel=None): # cancel is the job's CancelToken; waiting gives up once it is cancelled. futures is updated in place when an abandoned copy is restarted, so release_copies sees the new one
+        results = []
+        for index, (folder, model_name) in enumerate(models):
+            for attempt in range(2):
+                try:
+                    results.append(cancel.result(futures[index]) if cancel is not None else futures[index].result())
+                    break
+                except JobCancelled as e:
+                    if cancel is not None and cancel.cancelled: # Only the caller's own cancellation stops the job
+                        raise
+                    if attempt == 0: # The copy was abandoned by the jobs that started it, but this one still needs the model
+                        print(f"{APP_NAME} - wait_for_models - Restarting abandoned copy of {folder}/{model_name}")
+                        futures[index] = self.ensure_model(folder, model_name)
+                        continue
+                    results.append({"folder": folder, "model_name": model_name, "status": "failed", "seconds": 0.0, "error": str(e)})
+                except Exception as e:
+                    results.append({"folder": folder, "model_name": model_name, "status": "failed", "seconds": 0.0, "error": str(e)})
+                    break
+        with self.lock:
+            self.save_index()
+        return results
+
+    def ensure_model(self, folder, model_name): # Returns a Future for one model and counts the caller as waiting for it; a copy already in progress for the same model is reused
+        rel_path = f"{folder}/{model_name}"
+        local_path = os.path.join(MODELS_FOLDER, folder, model_name)
+        with self.lock:
+            if rel_path in self.in_flight and not self.copy_waiters[rel_path]["cancel"].is_set(): # An abandoned copy is stopping and is never handed out; a new one is started next to it
+                self.copy_waiters[rel_path]["waiters"] += 1
+                return self.in_flight[rel_path]
+            if os.path.exists(local_path):
+                self.touch(rel_path, os.path.getsize(local_path), managed=False)
+                future = Future()
+                future.set_result({"folder": folder, "model_name": model_name, "status": "cached", "seconds": 0.0})
+                return future
+            cancel_event = threading.Event()
+            future = self.copy_pool.submit(self.copy_model, folder, model_name, cancel_event)
+            self.in_flight[rel_path] = future
+            self.copy_waiters[rel_path] = {"future": future, "waiters": 1, "cancel": cancel_event}
+            return future
+
+    def copy_model(self, folder, model_name, cancel_event): # Runs in the copy pool
+        rel_path = f"{folder}/{model_name}"
+        source_path = os.path.join(NETWORK_STORAGE, folder, model_name)
+        local_path = os.path.join(MODELS_FOLDER, folder, model_name)
+        temp_path = f"{local_path}.{uuid.uuid4().hex}{PARTIAL_SUFFIX}"
+        start_time = time.time()
+        reserved = 0
+        try:
+            if cancel_event.is_set(): # Every job that wanted it was cancelled before the copy started
+                raise JobCancelled(f"Copy of {rel_path} abandoned before it started")
+            if not os.path.exists(source_path): # Not on network storage either; ComfyUI may still resolve it (e.g. built-in names), so let it decide
+                return {"folder": folder, "model_name": model_name, "status": "missing", "seconds": 0.0}
+            size = os.path.getsize(source_path)
+            self.make_room(size)
+            reserved = size
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            print(f"Model {model_name} not found in {os.path.dirname(local_path)}. Copying from storage.")
+            copy_file_chunked(source_path, temp_path, cancel_event)
+            os.replace(temp_path, local_path) # Atomic: ComfyUI either sees the whole file or no file
+            with self.lock:
+                self.touch(rel_path, size, managed=True)
+            return {"folder": folder, "model_name": model_name, "status": "copied", "seconds": time.time() - start_time, "bytes": size}
+        except JobCancelled as e:
+            print(f"{APP_NAME} - copy_model - {e}")
+            raise
+        except Exception as e:
+            aws_connector = AWSConnector()
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            line_no = exc_traceback.tb_lineno
+            error_message = f'Unhandled error at line {line_no} copying {source_path}: {str(e)}'
+            print(APP_NAME + " - copy_model - " + error_message)
+            aws_connector.print_log('N/A', APP_NAME, error_message, level='ERROR')
+            raise RuntimeError(f"An error occurred while copying model {rel_path} in line {line_no}: {str(e)}")
+        finally:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            with self.lock:
+                if rel_path in self.copy_waiters and self.copy_waiters[rel_path]["cancel"] is cancel_event: # A newer copy of the same model may have replaced this one
+                    self.in_flight.pop(rel_path, None)
+                    self.copy_waiters.pop(rel_path, None)
+                self.reserved_bytes -= reserved
+
+    def make_room(self, size): # Reserves size bytes, evicting least recently used unpinned models until both the budget and the free-space floor hold
+        with self.lock:
+            evicted = []
+            while True:
+                managed_bytes = sum(entry["size"] for entry in self.index.values() if entry.get("managed"))
+                free_bytes = shutil.disk_usage(MODELS_FOLDER).free - self.reserved_bytes
+                over_budget = MODEL_CACHE_BUDGET_GB > 0 and managed_bytes + self.reserved_bytes + size > MODEL_CACHE_BUDGET_GB * GB
+                low_on_disk = free_bytes - size < MODEL_CACHE_MIN_FREE_GB * GB
+                if not (over_budget or low_on_disk):
+                    break
+                candidates = [(entry["last_access"], entry["size"], rel_path) for rel_path, entry in self.index.items() if entry.get("managed") and rel_path not in self.pinned and rel_path not in self.in_flight]
+                if not candidates:
+                    print(f"Model cache cannot free enough space for {size} bytes; copying anyway.")
+                    break
+                _, victim_size, victim = min(candidates) # Least recently used first; ties go to the smaller file
+                try:
+                    os.unlink(os.path.join(MODELS_FOLDER, victim))
+                except FileNotFoundError:
+                    pass
+                del self.index[victim]
+                evicted.append((victim, victim_size))
+            self.reserved_bytes += size
+            if evicted:
+                self.save_index()
+                AWSConnector().print_log('N/A', APP_NAME, f"Model cache evicted {len(evicted)} models to make room for {size} bytes: {evicted}", level='INFO')
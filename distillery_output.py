@@ -0,0 +1,258 @@
+#### Distillery Output Stage - Bounded producer/consumer pipeline that adds metadata to generated images and uploads them to S3
+
+import io
+import json
+import os
+import sys
+import threading
+import uuid
+import zlib
+import base64
+import multiprocessing
+from typing import NamedTuple, Optional
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from PIL import Image, PngImagePlugin, features
+from distillery_png import is_png, read_text_chunk, replace_text_chunk
+from distillery_aws import AWSConnector
+from distillery_cancel import JobCancelled
+from distillery_metrics import JobTrace
+
+APP_NAME = os.getenv('APP_NAME') # Name of the application
+OUTPUT_QUEUE_DEPTH = int(os.getenv('OUTPUT_QUEUE_DEPTH', '4')) # Maximum number of images held by the output stage at once; producers block beyond this
+OUTPUT_UPLOAD_THREADS = int(os.getenv('OUTPUT_UPLOAD_THREADS', '4')) # Number of threads issuing S3 PUTs
+OUTPUT_ENCODE_PROCESSES = int(os.getenv('OUTPUT_ENCODE_PROCESSES', '2')) # Number of processes re-encoding outputs that cannot be spliced
+OUTPUT_FORMAT = os.getenv('OUTPUT_FORMAT', 'png').lower() # Default format of uploaded images: png, webp, jpeg (or avif where Pillow supports it); a job can override every OUTPUT_ and THUMBNAIL_ default with output_options
+OUTPUT_QUALITY = int(os.getenv('OUTPUT_QUALITY', '90')) # Default quality of lossy outputs, 1-100
+OUTPUT_PNG_COMPRESS_LEVEL = int(os.getenv('OUTPUT_PNG_COMPRESS_LEVEL')) if os.getenv('OUTPUT_PNG_COMPRESS_LEVEL') else None # zlib level 0-9 of re-encoded PNGs; unset keeps ComfyUI's PNG bytes and only splices the metadata in
+THUMBNAIL_SIZE = int(os.getenv('THUMBNAIL_SIZE', '0')) # Default longest side of the thumbnail uploaded next to each image; 0 disables thumbnails
+THUMBNAIL_FORMAT = os.getenv('THUMBNAIL_FORMAT', 'webp').lower() # Default format of thumbnails
+THUMBNAIL_QUALITY = int(os.getenv('THUMBNAIL_QUALITY', '75')) # Default quality of lossy thumbnails, 1-100
+OUTPUT_FORMATS = {"png": ("PNG", ".png"), "webp": ("WEBP", ".webp"), "jpeg": ("JPEG", ".jpg")} # Format name -> (PIL format, file extension)
+if features.check('avif'):
+    OUTPUT_FORMATS["avif"] = ("AVIF", ".avif")
+EXIF_IMAGE_DESCRIPTION = 0x010E # EXIF tag holding the job metadata in formats without text chunks
+JPEG_EXIF_LIMIT = 65000 # A JPEG APP1 segment holds at most 64 KB; larger metadata is stored compressed
+COMPRESSED_METADATA_PREFIX = 'zlib:' # Marks metadata stored as base64 of zlib-compressed JSON
+
+class OutputOptions(NamedTuple): # Per-job encoding of the uploaded images; picklable, so it travels to the encode processes
+    format: str = 'png'
+    quality: int = 90
+    lossless: bool = False
+    png_compress_level: Optional[int] = None # None keeps ComfyUI's PNG bytes
+    thumbnail_size: int = 0
+    thumbnail_format: str = 'webp'
+    thumbnail_quality: int = 75
+
+    @property
+    def passthrough(self): # Whether the original is ComfyUI's own PNG with the metadata spliced in, without decoding it
+        return self.format == 'png' and self.png_compress_level is None
+
+    def cache_identity(self): # What the result cache must tell apart; None when the outputs are the ones every job got before output options existed
+        if self.passthrough and not self.thumbnail_size:
+            return None
+        return self._asdict()
+
+def is_integer(value): # JSON true and false decode to bool, which Python counts as int
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def parse_output_options(requested=None): # Validates a job's output_options over the worker defaults; raises ValueError on an unknown key or value
+    requested = dict(requested or {})
+    unknown = set(requested) - set(OutputOptions._fields)
+    if unknown:
+        raise ValueError(f"Unknown output_options {sorted(unknown)}; expected some of {list(OutputOptions._fields)}")
+    options = OutputOptions(OUTPUT_FORMAT, OUTPUT_QUALITY, False, OUTPUT_PNG_COMPRESS_LEVEL, THUMBNAIL_SIZE, THUMBNAIL_FORMAT, THUMBNAIL_QUALITY)._replace(**requested)
+    options = options._replace(format=str(options.format).lower(), thumbnail_format=str(options.thumbnail_format).lower())
+    for name in ('format', 'thumbnail_format'):
+        if getattr(options, name) not in OUTPUT_FORMATS:
+            raise ValueError(f"Unsupported {name} {getattr(options, name)!r}; expected one of {sorted(OUTPUT_FORMATS)}")
+    for name in ('quality', 'thumbnail_quality'):
+        if not is_integer(getattr(options, name)) or not 1 <= getattr(options, name) <= 100:
+            raise ValueError(f"{name} must be an integer from 1 to 100")
+    if options.png_compress_level is not None and (not is_integer(options.png_compress_level) or not 0 <= options.png_compress_level <= 9):
+        raise ValueError("png_compress_level must be an integer from 0 to 9")
+    if not is_integer(options.thumbnail_size) or options.thumbnail_size < 0:
+        raise ValueError("thumbnail_size must be a non-negative integer")
+    if not isinstance(options.lossless, bool): # A string such as "no" would be truthy
+        raise ValueError("lossless must be true or false")
+    if options.lossless and options.format == 'jpeg':
+        raise ValueError("JPEG has no lossless mode")
+    return options
+
+def output_filename(options): # Unique S3 key of one uploaded image
+    return f'distillery_{str(uuid.uuid4())}{OUTPUT_FORMATS[options.format][1]}'
+
+def thumbnail_filename(filename, options): # Key of the thumbnail uploaded next to filename
+    return f'{os.path.splitext(filename)[0]}_thumb{OUTPUT_FORMATS[options.thumbnail_format][1]}'
+
+def build_metadata(existing_metadata_str, template_inputs): # Combines the ComfyUI prompt stored in the image with the template inputs of the job
+    combined_metadata = {}
+    existing_metadata = json.loads(existing_metadata_str) if existing_metadata_str else None # Outputs of non-PNG savers carry no prompt chunk
+    combined_metadata['comfy_api'] = existing_metadata
+    combined_metadata['template_inputs'] = template_inputs
+    return json.dumps(combined_metadata)
+
+def build_thumbnail_metadata(original_key, template_inputs): # Thumbnails only point at their original, so a large workflow never outweighs the preview itself
+    reference = {key: template_inputs[key] for key in ('NOISE_SEED', 'BATCH_INDEX') if key in template_inputs}
+    return json.dumps({'original': original_key, 'template_inputs': reference})
+
+def splice_png_metadata(image_data, template_inputs): # Fast path: rewrites the 'prompt' text chunk in place and copies the image data untouched
+    metadata_str = build_metadata(read_text_chunk(image_data, 'prompt'), template_inputs)
+    return replace_text_chunk(image_data, 'prompt', metadata_str)
+
+def save_image(image, format_name, quality, lossless, png_compress_level, metadata_str): # Encodes one image with the metadata embedded: a 'prompt' text chunk in PNG, EXIF ImageDescription elsewhere
+    image_file = io.BytesIO()
+    pil_format = OUTPUT_FORMATS[format_name][0]
+    if format_name == 'png':
+        pnginfo = PngImagePlugin.PngInfo()
+        pnginfo.add_text('prompt', metadata_str)
+        image.save(image_file, format=pil_format, pnginfo=pnginfo, compress_level=6 if png_compress_level is None else png_compress_level)
+        return image_file.getvalue()
+    if format_name == 'jpeg' and len(metadata_str) > JPEG_EXIF_LIMIT:
+        metadata_str = COMPRESSED_METADATA_PREFIX + base64.b64encode(zlib.compress(metadata_str.encode('utf-8'), 9)).decode('ascii')
+    exif = Image.Exif()
+    exif[EXIF_IMAGE_DESCRIPTION] = metadata_str # build_metadata writes ASCII-only JSON, as EXIF strings require
+    if format_name == 'jpeg' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    image.save(image_file, format=pil_format, quality=quality, lossless=lossless, exif=exif.tobytes())
+    return image_file.getvalue()
+
+def encode_image(image_data, template_inputs, options, include_original=True, original_key=None): # Runs in the process pool: decodes the image once and returns [original, thumbnail], each entry present only if requested; the thumbnail's metadata references original_key
+    image = Image.open(io.BytesIO(image_data))
+    metadata_str = build_metadata(image.info.get('prompt'), template_inputs)
+    encoded = []
+    if include_original:
+        encoded.append(save_image(image, options.format, options.quality, options.lossless, options.png_compress_level, metadata_str))
+    if options.thumbnail_size:
+        thumbnail = image.copy()
+        thumbnail.thumbnail((options.thumbnail_size, options.thumbnail_size), Image.Resampling.LANCZOS) # Keeps the aspect ratio; never upscales
+        encoded.append(save_image(thumbnail, options.thumbnail_format, options.thumbnail_quality, False, options.png_compress_level, build_thumbnail_metadata(original_key, template_inputs)))
+    return encoded
+
+def read_image_metadata(data): # Returns the metadata embedded by the output stage in an uploaded image of any supported format, or None; a thumbnail's holds the key of its original and the seed
+    if is_png(data):
+        metadata_str = read_text_chunk(data, 'prompt')
+    else:
+        metadata_str = Image.open(io.BytesIO(data)).getexif().get(EXIF_IMAGE_DESCRIPTION)
+    if metadata_str is None:
+        return None
+    if metadata_str.startswith(COMPRESSED_METADATA_PREFIX):
+        metadata_str = zlib.decompress(base64.b64decode(metadata_str[len(COMPRESSED_METADATA_PREFIX):])).decode('utf-8')
+    return json.loads(metadata_str)
+
+class OutputBatch: # Tracks the images of one job as they go through the output stage
+    def __init__(self, stage, cancel=None, trace=None, options=None):
+        self.stage = stage
+        self.options = options or OutputOptions() # Format and thumbnail of every image of the job
+        self.cancel = cancel # The job's CancelToken; on cancel, images not yet being processed are dropped
+        self.trace = trace or JobTrace() # Encode and upload times of the job's images add up here
+        self.futures = []
+        if cancel is not None:
+            cancel.on_cancel(self.abandon)
+
+    def submit(self, image_data, template_inputs, on_uploaded=None): # Hands the raw bytes of an image to the output stage; blocks while the stage already holds OUTPUT_QUEUE_DEPTH images; on_uploaded(filename) is called from the upload thread once the image (and its thumbnail) is in S3
+        filename = output_filename(self.options)
+        if self.cancel is not None:
+            self.cancel.acquire(self.stage.slots) # Backpressure: wait for a free slot before taking ownership of another image
+        else:
+            self.stage.slots.acquire()
+        try:
+            future = self.stage.upload_pool.submit(self.stage.encode_and_upload, image_data, template_inputs, filename, on_uploaded, self.cancel, self.trace, self.options)
+        except Exception:
+            self.stage.slots.release()
+            raise
+        self.futures.append(future)
+        return filename
+
+    def results(self): # Waits for every submitted image and returns the S3 keys in submission order
+        if self.cancel is not None:
+            return [self.cancel.result(future) for future in self.futures]
+        return [future.result() for future in self.futures]
+
+    def abandon(self): # Drops the images still waiting for an upload thread; the ones being processed stop at their next check
+        for future in list(self.futures):
+            if future.cancel(): # Never started, so encode_and_upload will not release its slot
+                self.stage.slots.release()
+
+class OutputStage:
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __new__(cls):
+        with cls._instance_lock: # Concurrent jobs share one stage, so its queue depth is a worker-wide limit
+            if cls._instance is None:
+                instance = super().__new__(cls)
+                instance.slots = threading.BoundedSemaphore(OUTPUT_QUEUE_DEPTH)
+                instance.upload_pool = ThreadPoolExecutor(max_workers=OUTPUT_UPLOAD_THREADS, thread_name_prefix='distillery-upload')
+                instance.encode_lock = threading.Lock()
+                instance.encode_pool = instance.new_encode_pool()
+                cls._instance = instance
+        return cls._instance
+
+    @staticmethod
+    def new_encode_pool(): # forkserver children start from a clean process instead of copying the worker's log, websocket and upload threads
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['distillery_output']) # Imported once in the fork server, so each child starts with PIL loaded
+        return ProcessPoolExecutor(max_workers=OUTPUT_ENCODE_PROCESSES, mp_context=context)
+
+    def encode(self, *args): # encode_image in the process pool; a child dying (e.g. OOM-killed) breaks the whole pool, so it is replaced and the image tried once more
+        for attempt in range(2):
+            pool = self.encode_pool
+            try:
+                return pool.submit(encode_image, *args).result()
+            except BrokenProcessPool:
+                with self.encode_lock:
+                    if self.encode_pool is pool: # Images encoding alongside see the same broken pool; only the first replaces it
+                        AWSConnector().print_log('N/A', APP_NAME, "Encode process died; replacing the encode pool", level='WARNING')
+                        pool.shutdown(wait=False)
+                        self.encode_pool = self.new_encode_pool()
+                if attempt:
+                    raise
+
+    def start_batch(self, cancel=None, trace=None, options=None):
+        return OutputBatch(self, cancel, trace, options)
+
+    def encode_and_upload(self, image_data, template_inputs, filename, on_uploaded=None, cancel=None, trace=None, options=None): # Runs in the upload pool: PNGs kept as they are get their metadata spliced in place; other formats, compression levels and thumbnails are encoded in the process pool
+        try:
+            aws_connector = AWSConnector()
+            if cancel is not None:
+                cancel.raise_if_cancelled()
+            trace = trace or JobTrace()
+            options = options or OutputOptions()
+            original_bytes = None
+            with trace.stage('encode'):
+                if options.passthrough and is_png(image_data):
+                    try:
+                        original_bytes = splice_png_metadata(image_data, template_inputs)
+                    except ValueError as e: # Malformed chunk stream; let PIL deal with it
+                        print(f"Could not splice metadata into {filename}, re-encoding instead: {e}")
+                encoded = []
+                if original_bytes is None or options.thumbnail_size:
+                    encoded = self.encode(bytes(image_data), template_inputs, options, original_bytes is None, filename) # Memory-mapped outputs cannot be pickled; send a copy
+                if original_bytes is None:
+                    original_bytes = encoded.pop(0)
+            if cancel is not None:
+                cancel.raise_if_cancelled() # Checked again as re-encoding can take a while
+            files = [(io.BytesIO(original_bytes), filename)]
+            if encoded:
+                files.append((io.BytesIO(encoded[0]), thumbnail_filename(filename, options)))
+            with trace.stage('s3_upload'):
+                upload_results = aws_connector.upload_fileobj(files) # The thumbnail goes up alongside, so it exists whenever the original does
+            failed = [result for result in upload_results if not result.success]
+            if failed:
+                raise RuntimeError(f"S3 upload failed: {[result.error for result in failed]}")
+            if on_uploaded is not None:
+                on_uploaded(filename) # Before the future resolves, so the notification is never later than results()
+            return filename
+        except JobCancelled:
+            raise
+        except Exception as e:
+            aws_connector = AWSConnector()
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            line_no = exc_traceback.tb_lineno
+            error_message = f'Unhandled error at line {line_no}: {str(e)}'
+            print(APP_NAME + " - encode_and_upload - " + error_message)
+            aws_connector.print_log('N/A', APP_NAME, error_message, level='ERROR')
+            raise RuntimeError(f"An error occurred while encoding and uploading {filename} in line {line_no}: {str(e)}")
+        finally:
+            self.slots.release()
@@ -0,0 +1,79 @@
+#### Distillery PNG - Reads and rewrites PNG text chunks directly on the chunk stream, without decoding the image
+
+import struct
+import zlib
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+TEXT_CHUNK_TYPES = (b'tEXt', b'zTXt', b'iTXt')
+
+def is_png(data): # Checks the 8-byte PNG signature
+    return bytes(data[:8]) == PNG_SIGNATURE
+
+def iter_chunks(data): # Yields (chunk_type, start, end) for every chunk; start/end delimit the whole chunk including length, type and CRC
+    view = memoryview(data)
+    if not is_png(view):
+        raise ValueError("Data is not a PNG file")
+    offset = len(PNG_SIGNATURE)
+    while offset < len(view):
+        if offset + 8 > len(view):
+            raise ValueError(f"Truncated PNG chunk header at offset {offset}")
+        length, chunk_type = struct.unpack_from('>I4s', view, offset)
+        end = offset + 12 + length
+        if end > len(view):
+            raise ValueError(f"Truncated PNG chunk {chunk_type!r} at offset {offset}")
+        yield chunk_type, offset, end
+        offset = end
+        if chunk_type == b'IEND':
+            break
+
+def parse_text_chunk(chunk_type, body): # Returns (keyword, text) for a tEXt, zTXt or iTXt chunk body; raises ValueError on a malformed one, like every other parsing error here
+    keyword, _, rest = bytes(body).partition(b'\x00')
+    keyword = keyword.decode('latin-1')
+    try:
+        if chunk_type == b'tEXt':
+            return keyword, rest.decode('latin-1')
+        if chunk_type == b'zTXt':
+            return keyword, zlib.decompress(rest[1:]).decode('latin-1') # First byte is the compression method
+        compressed, _method = rest[0], rest[1] # iTXt: compression flag, compression method, language tag, translated keyword, text
+        _language, _, rest = rest[2:].partition(b'\x00')
+        _translated, _, text = rest.partition(b'\x00')
+        if compressed:
+            text = zlib.decompress(text)
+        return keyword, text.decode('utf-8')
+    except (zlib.error, IndexError) as e:
+        raise ValueError(f"Malformed {chunk_type.decode('latin-1')} chunk {keyword!r}: {e}") from e
+
+def read_text_chunk(data, keyword): # Returns the text stored under keyword, or None if there is no such chunk
+    view = memoryview(data)
+    for chunk_type, start, end in iter_chunks(view):
+        if chunk_type in TEXT_CHUNK_TYPES:
+            chunk_keyword, text = parse_text_chunk(chunk_type, view[start + 8:end - 4])
+            if chunk_keyword == keyword:
+                return text
+        elif chunk_type == b'IDAT': # ComfyUI (and PIL) write text chunks before the image data
+            break
+    return None
+
+def build_text_chunk(keyword, text): # Builds a complete chunk with a valid CRC; tEXt when the text is latin-1, iTXt otherwise (same rule as PIL)
+    try:
+        chunk_type = b'tEXt'
+        body = keyword.encode('latin-1') + b'\x00' + text.encode('latin-1')
+    except UnicodeEncodeError:
+        chunk_type = b'iTXt'
+        body = keyword.encode('latin-1') + b'\x00\x00\x00\x00\x00' + text.encode('utf-8')
+    return struct.pack('>I', len(body)) + chunk_type + body + struct.pack('>I', zlib.crc32(chunk_type + body) & 0xffffffff)
+
+def replace_text_chunk(data, keyword, text): # Returns a new PNG where every text chunk for keyword is replaced by one chunk holding text; all other chunks are copied byte-for-byte
+    view = memoryview(data)
+    parts = [view[:len(PNG_SIGNATURE)]]
+    new_chunk = build_text_chunk(keyword, text)
+    for chunk_type, start, end in iter_chunks(view):
+        if chunk_type in TEXT_CHUNK_TYPES and parse_text_chunk(chunk_type, view[start + 8:end - 4])[0] == keyword:
+            continue # Drop the old chunk
+        if chunk_type == b'IDAT' and new_chunk is not None:
+            parts.append(new_chunk) # Text chunks go before the first IDAT so readers that stop at image data still see them
+            new_chunk = None
+        parts.append(view[start:end])
+    if new_chunk is not None:
+        raise ValueError("PNG has no IDAT chunk")
+    return b''.join(parts)
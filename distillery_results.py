@@ -0,0 +1,127 @@
+#### Distillery Result Cache - Content-addressed index from (workflow, inputs, seed) to the S3 keys already generated for it
+
+import os
+import sys
+import json
+import time
+import uuid
+import hashlib
+import sqlite3
+import threading
+from distillery_aws import AWSConnector
+
+APP_NAME = os.getenv('APP_NAME') # Name of the application
+RESULT_CACHE_ENABLED = os.getenv('RESULT_CACHE_ENABLED', 'true').lower() == 'true' # Whether repeated requests are answered from earlier results; a job can also set bypass_result_cache
+RESULT_CACHE_PATH = os.getenv('RESULT_CACHE_PATH', 'distillery_result_cache.sqlite3') # Local SQLite index
+RESULT_CACHE_TTL_HOURS = float(os.getenv('RESULT_CACHE_TTL_HOURS', '24')) # Entries older than this are never served; keep it below the lifetime of the output objects in S3
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv('RESULT_CACHE_MAX_ENTRIES', '100000')) # Least recently used entries are evicted beyond this
+RESULT_CACHE_S3_KEY = os.getenv('RESULT_CACHE_S3_KEY', '') # Optional S3 key the index is mirrored to, so new workers start warm; empty disables the mirror
+RESULT_CACHE_MIRROR_INTERVAL = float(os.getenv('RESULT_CACHE_MIRROR_INTERVAL', '300')) # Minimum seconds between uploads of the mirror
+
+def canonical_hash(value): # SHA-256 of a JSON value with sorted keys, so equal graphs hash equally whatever the order the client sent them in
+    return hashlib.sha256(json.dumps(value, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def result_key(comfy_api, input_hashes, seed, output_options=None): # Key of one seed variant: the full graph (seed already patched in), the content of every input image, the seed and, unless they are the defaults, the output options
+    value = {"comfy_api": comfy_api, "inputs": input_hashes, "seed": seed}
+    if output_options is not None: # Left out for default outputs, so entries written before output options existed stay valid
+        value["output_options"] = output_options
+    return canonical_hash(value)
+
+class ResultCache:
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __new__(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                instance = super().__new__(cls)
+                instance.lock = threading.Lock()
+                instance.hits = 0
+                instance.misses = 0
+                instance.last_mirror = time.time()
+                instance.dirty = False
+                instance.restore_mirror()
+                instance.db = instance.connect()
+                cls._instance = instance
+        return cls._instance
+
+    def connect(self):
+        db = sqlite3.connect(RESULT_CACHE_PATH, check_same_thread=False, isolation_level=None) # Shared by the job threads under self.lock; autocommit
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, s3_keys TEXT NOT NULL, created REAL NOT NULL, last_access REAL NOT NULL)")
+        db.execute("CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access)")
+        return db
+
+    def restore_mirror(self): # Starts from the mirrored index when this worker has none yet
+        if not RESULT_CACHE_S3_KEY or os.path.exists(RESULT_CACHE_PATH):
+            return
+        result = AWSConnector().download_files([(RESULT_CACHE_PATH, RESULT_CACHE_S3_KEY)])[0]
+        if not result.success:
+            print(f"Result cache mirror not restored, starting empty: {result.error}")
+            if os.path.exists(RESULT_CACHE_PATH):
+                os.unlink(RESULT_CACHE_PATH)
+
+    def lookup(self, keys): # Returns {key: [s3_key, ...]} for the keys with a live entry; expired entries are deleted
+        now = time.time()
+        found = {}
+        with self.lock:
+            self.db.execute("DELETE FROM results WHERE created < ?", (now - RESULT_CACHE_TTL_HOURS * 3600,))
+            for key in keys:
+                row = self.db.execute("SELECT s3_keys FROM results WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    found[key] = json.loads(row[0])
+                    self.db.execute("UPDATE results SET last_access = ? WHERE key = ?", (now, key))
+        return found
+
+    def count(self, hits, misses): # Worker-wide counters, reported once a job has checked its hits still exist in S3
+        with self.lock:
+            self.hits += hits
+            self.misses += misses
+            return {"hits": self.hits, "misses": self.misses}
+
+    def store(self, key, s3_keys): # Records the outputs of one seed variant and evicts beyond RESULT_CACHE_MAX_ENTRIES
+        now = time.time()
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO results (key, s3_keys, created, last_access) VALUES (?, ?, ?, ?)", (key, json.dumps(s3_keys), now, now))
+            self.db.execute("DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY last_access DESC LIMIT -1 OFFSET ?)", (RESULT_CACHE_MAX_ENTRIES,))
+            self.dirty = True
+            mirror_due = RESULT_CACHE_S3_KEY and time.time() - self.last_mirror >= RESULT_CACHE_MIRROR_INTERVAL
+        if mirror_due:
+            threading.Thread(target=self.maybe_mirror, name='distillery-result-mirror', daemon=True).start() # Off the job's critical path
+
+    def forget(self, keys): # Drops entries whose objects turned out to be gone from S3
+        with self.lock:
+            self.db.executemany("DELETE FROM results WHERE key = ?", [(key,) for key in keys])
+            self.dirty = True
+
+    def maybe_mirror(self): # Uploads a consistent snapshot of the index at most every RESULT_CACHE_MIRROR_INTERVAL seconds
+        if not RESULT_CACHE_S3_KEY:
+            return
+        with self.lock:
+            if not self.dirty or time.time() - self.last_mirror < RESULT_CACHE_MIRROR_INTERVAL:
+                return
+            snapshot_path = f"{RESULT_CACHE_PATH}.{uuid.uuid4().hex}.snapshot"
+            try:
+                snapshot = sqlite3.connect(snapshot_path)
+                self.db.backup(snapshot) # Online backup: a copy of the live file could be torn by a concurrent write
+                snapshot.close()
+                self.dirty = False
+                self.last_mirror = time.time()
+            except Exception as e:
+                print(f"Could not snapshot the result cache: {e}")
+                if os.path.exists(snapshot_path):
+                    os.unlink(snapshot_path)
+                return
+        try:
+            result = AWSConnector().upload_files([(snapshot_path, RESULT_CACHE_S3_KEY)])[0]
+            if not result.success:
+                print(f"Could not mirror the result cache to S3: {result.error}")
+        except Exception as e:
+            aws_connector = AWSConnector()
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            line_no = exc_traceback.tb_lineno
+            error_message = f'Unhandled error at line {line_no}: {str(e)}'
+            print(APP_NAME + " - maybe_mirror - " + error_message)
+            aws_connector.print_log('N/A', APP_NAME, error_message, level='ERROR')
+        finally:
+            os.unlink(snapshot_path)
@@ -0,0 +1,130 @@
+#### Distillery Templates - One-time analysis of ComfyUI workflows into compiled templates with cheap copy-on-write variants
+
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+TEMPLATE_CACHE_SIZE = int(os.getenv('TEMPLATE_CACHE_SIZE', '64')) # Number of compiled templates kept, least recently used first out
+SAVE_OUTPUT_CLASSES = {"SaveImage"} # Nodes whose outputs are returned to the client; only still-image savers, as the output stage splices or re-encodes every file as one image
+SAVE_OUTPUT_CLASSES.update(json.loads(os.getenv('SAVE_OUTPUT_CLASSES') or '[]')) # Extra still-image saver classes as a JSON list, e.g. '["Image Save"]'; animated and video savers are not supported
+INPUT_IMAGE_NODES = {"LoadImage": "image", "LoadImageMask": "image"} # Node class -> input holding the name of an uploaded input image
+LATENT_BATCH_NODES = {"EmptyLatentImage": "batch_size", "EmptySD3LatentImage": "batch_size"} # Latent source class -> input holding its batch size
+BATCH_SAVE_CLASSES = {"SaveImage"} # Savers known to write one file per image of a batch
+BATCH_UNSAFE_CLASSES = {"LatentFromBatch", "ImageFromBatch", "RepeatLatentBatch", "RepeatImageBatch", "RebatchLatents", "RebatchImages", "LatentBatch", "ImageBatch", "LatentBatchSeedBehavior"} # Nodes that index, repeat, split or merge batches, so a batched latent changes what they output
+
+def node_sort_key(node_id): # ComfyUI node ids are numeric strings; sort them numerically so outputs keep the graph's order
+    return (0, int(node_id), '') if str(node_id).isdigit() else (1, 0, str(node_id))
+
+def patch(comfy_api, patches): # Returns a copy of comfy_api with each (path, value) applied; only the dicts along a patched path are copied, every other node is shared
+    patched = dict(comfy_api)
+    copied = {id(patched)}
+    for path, value in patches:
+        target = patched
+        for key in path[:-1]: # Traverse all but the last key in the path
+            child = target.get(key)
+            if not isinstance(child, dict):
+                target = None
+                break
+            if id(child) not in copied:
+                child = dict(child)
+                target[key] = child
+                copied.add(id(child))
+            target = child
+        if target is not None and path[-1] in target: # Same rule as before: only keys that already exist are updated
+            target[path[-1]] = value
+    return patched
+
+def structural_hash(comfy_api, seed_paths): # Hashes the graph's shape (node classes, input names and links), not its literal values, so prompts that only differ in text or numbers share a template
+    structure = []
+    for node_id in sorted(comfy_api, key=node_sort_key):
+        node = comfy_api[node_id]
+        if not isinstance(node, dict):
+            continue
+        inputs = node.get("inputs", {})
+        structure.append([node_id, node.get("class_type"), [[name, value if isinstance(value, list) else None] for name, value in sorted(inputs.items())]])
+    structure.append([list(path) for path in seed_paths])
+    return hashlib.sha256(json.dumps(structure, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+class CompiledTemplate:
+    def __init__(self, comfy_api, seed_paths, template_hash):
+        self.hash = template_hash
+        self.seed_paths = [tuple(path) for path in seed_paths] # Patch points for the noise seed
+        self.input_image_paths = [] # Patch points holding input image names
+        self.output_nodes = [] # Saver nodes, in graph order; their files are the job's outputs
+        self.batch_size_paths = [] # Patch points of the latent batch size
+        unsafe_classes = set()
+        linked_batch_size = False
+        for node_id in sorted(comfy_api, key=node_sort_key):
+            node = comfy_api[node_id]
+            if not isinstance(node, dict):
+                continue
+            class_type = node.get("class_type")
+            if class_type in SAVE_OUTPUT_CLASSES:
+                self.output_nodes.append(node_id)
+            if class_type in INPUT_IMAGE_NODES and INPUT_IMAGE_NODES[class_type] in node.get("inputs", {}):
+                self.input_image_paths.append((node_id, "inputs", INPUT_IMAGE_NODES[class_type]))
+            if class_type in LATENT_BATCH_NODES:
+                self.batch_size_paths.append((node_id, "inputs", LATENT_BATCH_NODES[class_type]))
+                linked_batch_size = linked_batch_size or isinstance(node.get("inputs", {}).get(LATENT_BATCH_NODES[class_type]), list)
+            if class_type in BATCH_UNSAFE_CLASSES:
+                unsafe_classes.add(class_type)
+        self.batch_blocker = None # Why the graph cannot run several seeds as one latent batch, or None if it can
+        if len(self.batch_size_paths) != 1:
+            self.batch_blocker = f"expected one latent node of {sorted(LATENT_BATCH_NODES)}, found {len(self.batch_size_paths)}"
+        elif linked_batch_size:
+            self.batch_blocker = "the latent batch size comes from another node"
+        elif len(self.output_nodes) != 1 or comfy_api[self.output_nodes[0]].get("class_type") not in BATCH_SAVE_CLASSES:
+            self.batch_blocker = f"expected a single output node of {sorted(BATCH_SAVE_CLASSES)}"
+        elif unsafe_classes:
+            self.batch_blocker = f"nodes {sorted(unsafe_classes)} change the batch"
+
+    def with_seed(self, comfy_api, seed): # Copy-on-write variant of comfy_api with every seed patch point set to seed
+        return patch(comfy_api, [(path, seed) for path in self.seed_paths])
+
+    def with_batch_size(self, comfy_api, batch_size): # Copy-on-write variant of comfy_api whose latent node produces batch_size images; only meaningful when batch_blocker is None
+        return patch(comfy_api, [(path, batch_size) for path in self.batch_size_paths])
+
+    def with_input_images(self, comfy_api, names): # Copy-on-write variant of comfy_api whose input image nodes read the uploaded files; names maps what a node holds (an S3 key or its file name) to the name in ComfyUI's input folder
+        patches = []
+        for path in self.input_image_paths:
+            node_id, _, input_name = path
+            value = comfy_api[node_id]["inputs"].get(input_name)
+            if isinstance(value, str) and value in names:
+                patches.append((path, names[value]))
+        return patch(comfy_api, patches)
+
+    def output_files(self, history): # Lists every file written by the template's saver nodes, in graph order, from a /history entry
+        files = []
+        for node_id in self.output_nodes:
+            files.extend(history['outputs'].get(node_id, {}).get('images', []))
+        return files
+
+class TemplateCache:
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __new__(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                instance = super().__new__(cls)
+                instance.templates = OrderedDict() # Structural hash -> CompiledTemplate, most recently used last
+                instance.lock = threading.Lock()
+                cls._instance = instance
+        return cls._instance
+
+    def get(self, comfy_api, seed_paths=()): # Returns the compiled template for comfy_api, analysing it only if its structure was not seen recently
+        template_hash = structural_hash(comfy_api, seed_paths)
+        with self.lock:
+            template = self.templates.get(template_hash)
+            if template is not None:
+                self.templates.move_to_end(template_hash)
+                return template
+        template = CompiledTemplate(comfy_api, seed_paths, template_hash)
+        with self.lock:
+            self.templates[template_hash] = template
+            self.templates.move_to_end(template_hash)
+            while len(self.templates) > TEMPLATE_CACHE_SIZE:
+                self.templates.popitem(last=False)
+        return template
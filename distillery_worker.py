@@ -1,17 +1,22 @@
 ##### Distillery Worker for serverless Runpod - Comfy - Version 2.5 Eau de Vie - Sep 20 2023
 
 import time
+import asyncio
+import threading
 import runpod
 import uuid
 from distillery_aws import AWSConnector
 from distillery_comfy import ComfyConnector
+from distillery_output import OutputStage, parse_output_options, thumbnail_filename
+from distillery_models import ModelCache, find_workflow_models
+from distillery_templates import TemplateCache, SAVE_OUTPUT_CLASSES
+from distillery_cancel import CancelToken, JobCancelled
+from distillery_results import ResultCache, RESULT_CACHE_ENABLED, result_key
+from distillery_metrics import JobTrace, MetricsRegistry
 import os
-import io
+import functools
 from urllib.parse import urlparse
-from PIL import PngImagePlugin
-import json
 from concurrent.futures import ThreadPoolExecutor
-import copy
 import sys
 
 START_TIME = time.time() # Time at which the worker was initialized
@@ -20,66 +25,16 @@ INSTANCE_IDENTIFIER = APP_NAME+'-'+str(uuid.uuid4()) # Unique identifier for thi
 NETWORK_STORAGE = os.getenv("NETWORK_STORAGE") # Path to network storage mount
 MODELS_FOLDER = os.getenv("MODELS_FOLDER") # Path to models folder in ComfyUI
 WORKER_TIMEOUT = int(os.getenv("WORKER_TIMEOUT")) # Timeout for the worker in seconds
-
-def fetch_images(comfy_api, template_inputs):
-    try:
-        aws_connector = AWSConnector() 
-        comfy_connector = ComfyConnector()
-        image_files = []
-        images = comfy_connector.generate_images(comfy_api)
-        for image in images: 
-            # Create a unique filename
-            filename = f'distillery_{str(uuid.uuid4())}.png'
-
-            # Modify the metadata
-            combined_metadata = {}
-            existing_metadata_str= image.info.get('prompt')
-            existing_metadata = json.loads(existing_metadata_str)
-            combined_metadata['comfy_api'] = existing_metadata
-            combined_metadata['template_inputs'] = template_inputs
-            combined_metadata_str = json.dumps(combined_metadata)
-            pnginfo = PngImagePlugin.PngInfo()
-            pnginfo.add_text('prompt', combined_metadata_str)
-
-            # Save the image to an in-memory file object
-            image_file = io.BytesIO()
-            image.save(image_file, format='PNG', pnginfo=pnginfo)
-            image_file.seek(0)
-
-            # Upload the in-memory file to S3
-            aws_connector.upload_fileobj([(image_file, filename)]) # Upload the in-memory file to S3
-            image_files.append(filename)
-
-        return image_files # Return the list of keys of the images in S3
-    except Exception as e:
-        exc_type, exc_value, exc_traceback = sys.exc_info()
-        line_no = exc_traceback.tb_lineno
-        error_message = f'Unhandled error at line {line_no}: {str(e)}'
-        print(INSTANCE_IDENTIFIER + " - fetch_images - " + error_message)
-        aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, error_message, level='ERROR')
-        raise RuntimeError(f"An error occurred while fetching images in line {line_no}: {str(e)}")
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "1")) # Jobs this worker takes from RunPod at once; while one samples, others can stage inputs or upload outputs
+STREAM_RESULTS = os.getenv("STREAM_RESULTS", "false").lower() == "true" # Whether the worker runs as a RunPod generator handler that streams each S3 key as soon as it is uploaded; otherwise the job returns the full list at the end
+LATENT_BATCH = os.getenv("LATENT_BATCH", "false").lower() == "true" # Whether images_per_batch > 1 runs as one prompt with a batched latent instead of one prompt per seed; a job can override it with latent_batch
+LATENT_BATCH_MAX = int(os.getenv("LATENT_BATCH_MAX", "8")) # Most images sampled in one latent batch, which bounds GPU memory; larger jobs run several batches with consecutive seeds; 0 means no limit
+MAX_STAGING_JOBS = int(os.getenv("MAX_STAGING_JOBS", "2")) # Jobs allowed to stage models and input images at once, which bounds disk and network use; GPU queue depth is bounded by MAX_QUEUED_PROMPTS
+MODEL_TYPE_FOLDERS = {"sd_model": "checkpoints", "lora_model": "loras", "controlnet_model": "controlnet"} # Folder, under both NETWORK_STORAGE and MODELS_FOLDER, for each model type
+STAGING_SLOTS = threading.BoundedSemaphore(MAX_STAGING_JOBS)
+JOB_POOL = ThreadPoolExecutor(max_workers=2 * WORKER_CONCURRENCY, thread_name_prefix='distillery-job') # worker_routine is blocking, so each concurrent job runs on its own thread; twice the concurrency so a cancelled job still unwinding never delays the next one
 
 class InputPreprocessor:
-    @staticmethod
-    def update_paths(json_obj, paths, input_value):
-        try:
-            aws_connector = AWSConnector()
-            updated_json_obj = copy.deepcopy(json_obj)  # Create a deep copy of the original JSON object
-            for path in paths:
-                target = updated_json_obj
-                for key in path[:-1]:  # Traverse all but the last key in the path
-                    target = target.get(key, {})  # Use get to avoid KeyError
-                if path[-1] in target:  # Check if the key exists
-                    target[path[-1]] = input_value  # Update the value at the last key in the path
-            return updated_json_obj
-        except Exception as e:
-            exc_type, exc_value, exc_traceback = sys.exc_info()
-            line_no = exc_traceback.tb_lineno
-            error_message = f'Unhandled error at line {line_no}: {str(e)}'
-            print(INSTANCE_IDENTIFIER + " - update_paths - " + error_message)
-            aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, error_message, level='ERROR')
-            raise RuntimeError(f"An error occurred while updating the paths in line {line_no}: {str(e)}")
-
     @staticmethod
     def tally_models_to_fetch(template_inputs):
         try:
@@ -108,59 +63,136 @@ class InputPreprocessor:
             raise RuntimeError(f"An error occurred while tallying models to fetch in line {line_no}: {str(e)}")
 
     @staticmethod
-    def get_models_from_storage(models_list):
+    def resolve_model_folders(models_list): # Turns tallied models into unique (folder, model_name) pairs
+        models = []
+        for model in models_list:
+            folder = MODEL_TYPE_FOLDERS[model["model_type"]]
+            if model["model_name"] and (folder, model["model_name"]) not in models: # Unused template slots are empty strings
+                models.append((folder, model["model_name"]))
+        return models
+
+    @staticmethod
+    def models_for_job(comfy_api, template_inputs): # Every model the job needs: the ones named in template_inputs plus every loader node in the graph
+        models = InputPreprocessor.resolve_model_folders(InputPreprocessor.tally_models_to_fetch(template_inputs))
+        for model in find_workflow_models(comfy_api):
+            if model not in models:
+                models.append(model)
+        return models
+
+    @staticmethod
+    def get_models_from_storage(models, model_futures=None, cancel=None): # Makes every (folder, model_name) in models available in MODELS_FOLDER through the model cache; model_futures come from ModelCache.start_models when staging was started earlier
         try:
             aws_connector = AWSConnector()
             start_time = time.time()
-            copied_models = []
-            copied_models_times = []
-            total_models_processed = 0
-            for model in models_list:  # will iterate across all model types in the list
-                try:
-                    copy_start_time = time.time()
-                    model_path = None
-                    if model["model_type"] == "sd_model":
-                        model_type_path ="checkpoints"
-                        model_path = f"{MODELS_FOLDER}/checkpoints/"
-                    elif model["model_type"] == "lora_model":
-                        model_type_path ="loras"
-                        model_path = f"{MODELS_FOLDER}/loras/"
-                    elif model["model_type"] == "controlnet_model":
-                        model_type_path ="controlnet"
-                        model_path = f"{MODELS_FOLDER}/controlnet/"
-                    if not os.path.exists(f"{model_path}/{model['model_name']}"):
-                        print(f"Model {model['model_name']} not found in {model_path}. Copying from storage to {model_path}")
-                        os.system(f"cp {NETWORK_STORAGE}/{model_type_path}/{model['model_name']} {model_path}")
-                        copy_end_time = time.time()
-                        copied_models.append(model['model_name'])
-                        copied_models_times.append(copy_end_time - copy_start_time)
-                    else:
-                        print(f"Model {model['model_name']} found in {model_path}. Skipping copy.")
-                    total_models_processed += 1
-                except Exception as e:
-                    print(f"Error copying model {model['model_name']}: {e}")
-            end_time = time.time()
-            total_time_consumed = end_time - start_time
-            aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, f"All models processed. Total time consumed: {total_time_consumed} seconds. Total number of models processed: {total_models_processed}, List: {models_list}. Total number of models copied: {len(copied_models)}, List with times: {list(zip(copied_models, copied_models_times))}", level='INFO')
-            print(f"All models processed. Total time consumed: {total_time_consumed} seconds. Total number of models processed: {total_models_processed}, List: {models_list}. Total number of models copied: {len(copied_models)}, List with times: {list(zip(copied_models, copied_models_times))}")
+            model_cache = ModelCache()
+            if model_futures is None:
+                model_futures = model_cache.start_models(models)
+            results = model_cache.wait_for_models(models, model_futures, cancel) # Missing models are copied in parallel; copies already running for another job are shared
+            copied_models = [(result["model_name"], result["seconds"]) for result in results if result["status"] == "copied"]
+            failed_models = [(result["model_name"], result["error"]) for result in results if result["status"] == "failed"]
+            missing_models = [f"{result['folder']}/{result['model_name']}" for result in results if result["status"] == "missing"]
+            if missing_models:
+                aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, f"Models not found locally nor in {NETWORK_STORAGE}, leaving them to ComfyUI: {missing_models}", level='WARNING')
+            total_time_consumed = time.time() - start_time
+            summary = f"All models processed. Total time consumed: {total_time_consumed} seconds. Total number of models processed: {len(results)}, List: {models}. Total number of models copied: {len(copied_models)}, List with times: {copied_models}"
+            aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, summary, level='INFO')
+            print(summary)
+            if failed_models:
+                raise RuntimeError(f"Could not copy models from storage: {failed_models}")
+        except JobCancelled:
+            raise
         except Exception as e:
             exc_type, exc_value, exc_traceback = sys.exc_info()
             line_no = exc_traceback.tb_lineno
             error_message = f'Unhandled error at line {line_no}: {str(e)}'
             print(INSTANCE_IDENTIFIER + " - get_models_from_storage - " + error_message)
             aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, error_message, level='ERROR')
-            raise RuntimeError(f"An error occurred while getting models from storage in line {line_no}: {str(e)}. Variables were: Models List: {models_list}, model: {model}, model_path: {model_path}, model_type_path: {model_type_path}")
-
-def flatten_list(nested_list):
-    flat_list = []
-    for item in nested_list:
-        if isinstance(item, list):
-            flat_list.extend(flatten_list(item))
-        else:
-            flat_list.append(item)
-    return flat_list
-
-def worker_routine(event):
+            raise RuntimeError(f"An error occurred while getting models from storage in line {line_no}: {str(e)}. Variables were: Models List: {models}")
+
+    @staticmethod
+    def build_seed_variants(comfy_api, template, template_inputs, images_per_batch): # Returns one (comfy_api, template_inputs) pair per image, each with its own seed
+        variants = []
+        for i in range(images_per_batch):
+            variant_inputs = dict(template_inputs)
+            variant_inputs['NOISE_SEED'] = template_inputs['NOISE_SEED'] + i
+            if i == 0:
+                variant_api = comfy_api # The first image uses the workflow exactly as it was sent
+            else:
+                variant_api = template.with_seed(comfy_api, variant_inputs['NOISE_SEED']) # Copy-on-write: only the nodes holding the seed are copied
+            variants.append((variant_api, variant_inputs))
+        return variants
+
+    @staticmethod
+    def build_batch_variants(comfy_api, template, template_inputs, images_per_batch): # Returns (variants, None) with one variant per latent batch of up to LATENT_BATCH_MAX images, or (None, reason) when the graph cannot be batched safely
+        if template.batch_blocker is not None:
+            return None, template.batch_blocker
+        node_id, _, input_name = template.batch_size_paths[0]
+        if comfy_api[node_id]["inputs"][input_name] != 1:
+            return None, f"latent node {node_id} already has batch_size {comfy_api[node_id]['inputs'][input_name]}"
+        batch_limit = LATENT_BATCH_MAX or images_per_batch
+        variants = []
+        for i, start in enumerate(range(0, images_per_batch, batch_limit)):
+            variant_inputs = dict(template_inputs)
+            variant_inputs['NOISE_SEED'] = template_inputs['NOISE_SEED'] + i # One seed per batch; the images of a batch differ by BATCH_INDEX
+            variant_inputs['BATCH_SIZE'] = min(batch_limit, images_per_batch - start)
+            variant_api = comfy_api if i == 0 else template.with_seed(comfy_api, variant_inputs['NOISE_SEED'])
+            variants.append((template.with_batch_size(variant_api, variant_inputs['BATCH_SIZE']), variant_inputs))
+        return variants, None
+
+    @staticmethod
+    def image_inputs(variant_inputs, index): # Template inputs recorded in one image; images of a latent batch also record their position in it
+        if 'BATCH_SIZE' not in variant_inputs:
+            return variant_inputs
+        image_inputs = dict(variant_inputs)
+        image_inputs['BATCH_INDEX'] = index
+        return image_inputs
+
+    @staticmethod
+    def input_keys(template_inputs): # S3 keys of the input images the job uploads to ComfyUI
+        return [template_inputs[key] for key in ('INPUT_IMAGE', 'MASK_IMAGE', 'CONTROLNET_IMAGE') if template_inputs[key] != ""]
+
+    @staticmethod
+    def result_cache_keys(aws_connector, variants, input_keys, output_options=None): # One result-cache key per variant; input images are identified by their S3 ETag, so nothing is downloaded
+        head_results = aws_connector.head_objects(input_keys) if input_keys else []
+        failed = [result.key for result in head_results if not result.success]
+        if failed:
+            raise RuntimeError(f"Could not find {failed} in S3")
+        input_hashes = {result.key: result.etag for result in head_results}
+        cache_identity = output_options.cache_identity() if output_options is not None else None
+        return [result_key(variant_api, input_hashes, variant_inputs['NOISE_SEED'], cache_identity) for variant_api, variant_inputs in variants]
+
+    @staticmethod
+    def find_cached_results(aws_connector, cache_keys): # Returns {variant index: S3 keys} for the variants generated before whose outputs are all still in S3
+        found = ResultCache().lookup(cache_keys)
+        if not found:
+            return {}
+        outputs = [s3_key for s3_keys in found.values() for s3_key in s3_keys]
+        gone = {result.key for result in aws_connector.head_objects(outputs) if not result.success} # Expired by a bucket lifecycle rule or deleted
+        stale = [key for key, s3_keys in found.items() if gone.intersection(s3_keys)]
+        if stale:
+            ResultCache().forget(stale)
+        return {i: found[key] for i, key in enumerate(cache_keys) if key in found and key not in stale}
+
+def stream_uploaded_image(emit, job_start_time, image_index, seed_index, seed, s3_key, cached=False, batch_index=None, output_options=None): # Streams one finished image to the client; batch_index is its position in a latent batch
+    update = {"event": "image", "image_index": image_index, "seed_index": seed_index, "seed": seed, "s3_key": s3_key, "cached": cached, "elapsed_seconds": round(time.time() - job_start_time, 3)}
+    if batch_index is not None:
+        update["batch_index"] = batch_index
+    if output_options is not None and output_options.thumbnail_size:
+        update["thumbnail_key"] = thumbnail_filename(s3_key, output_options)
+    emit(update)
+
+def stream_progress(emit, seed_index, event_type, data): # Streams the sampler's step counter from the ComfyUI WebSocket
+    if event_type == 'progress':
+        emit({"event": "progress", "seed_index": seed_index, "step": data.get('value'), "steps": data.get('max')})
+
+def worker_routine(event, emit=None, cancel=None): # Runs one job and returns its S3 keys; with emit, each uploaded image (and, if the payload sets stream_progress, each sampling step) is also passed to emit as it happens; cancelling the CancelToken stops every stage of the job
+    trace = JobTrace()
+    job_start_time = trace.start
+    job_status = 'failed'
+    cancel = cancel or CancelToken()
+    pinned_models = []
+    model_futures = []
+    backend = None
     try:
         aws_connector = AWSConnector()
         comfy_connector = ComfyConnector()
@@ -172,46 +204,166 @@ def worker_routine(event):
         comfy_api = payload['comfy_api']
         template_inputs = payload['template_inputs']
         images_per_batch = payload['images_per_batch']    
-        if template_inputs['INPUT_IMAGE'] != "": comfy_connector.upload_from_s3_to_input(aws_connector, [template_inputs['INPUT_IMAGE']])
-        if template_inputs['MASK_IMAGE'] != "": comfy_connector.upload_from_s3_to_input(aws_connector, [template_inputs['MASK_IMAGE']])
-        if template_inputs['CONTROLNET_IMAGE'] != "": comfy_connector.upload_from_s3_to_input(aws_connector, [template_inputs['CONTROLNET_IMAGE']])
-        models_to_fetch = InputPreprocessor.tally_models_to_fetch(template_inputs)
-        InputPreprocessor.get_models_from_storage(models_to_fetch) # Copy models from network storage to ComfyUI
-        files = []
-        for i in range(images_per_batch):
-            file = fetch_images(comfy_api, template_inputs)
-            files.append(file)
-            template_inputs['NOISE_SEED']=template_inputs['NOISE_SEED']+1
-            comfy_api = InputPreprocessor.update_paths(comfy_api, template_inputs['NOISE_SEED_TEMPLATE_PATHS'], template_inputs['NOISE_SEED'])
-            print(f"Image {i+1} - New Seed: {template_inputs['NOISE_SEED']}")
-            aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, f"Image {i+1} - New Seed: {template_inputs['NOISE_SEED']}", level='INFO')    
-        #comfy_connector.kill_api()
-        corrected_files = flatten_list(files)
-        return corrected_files
+        output_options = parse_output_options(payload.get('output_options')) # Validated before any work is done
+        template = TemplateCache().get(comfy_api, template_inputs['NOISE_SEED_TEMPLATE_PATHS']) # Analysed once per workflow structure
+        if not template.output_nodes:
+            raise RuntimeError(f"Workflow has no output node; expected one of {sorted(SAVE_OUTPUT_CLASSES)}")
+        variants = None
+        if images_per_batch > 1 and payload.get('latent_batch', LATENT_BATCH):
+            variants, batch_blocker = InputPreprocessor.build_batch_variants(comfy_api, template, template_inputs, images_per_batch) # One prompt samples many images; text encoding and model setup run once
+            if variants is None:
+                aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, f"Latent batch not possible, running one prompt per seed: {batch_blocker}", level='INFO')
+        if variants is None:
+            variants = InputPreprocessor.build_seed_variants(comfy_api, template, template_inputs, images_per_batch)
+        input_keys = InputPreprocessor.input_keys(template_inputs)
+        cache_keys = InputPreprocessor.result_cache_keys(aws_connector, variants, input_keys, output_options) if RESULT_CACHE_ENABLED else []
+        cached_files = InputPreprocessor.find_cached_results(aws_connector, cache_keys) if cache_keys and not payload.get('bypass_result_cache') else {} # Repeats are answered without touching the GPU; bypass_result_cache forces a new generation, which then replaces the cached one
+        image_index = 0
+        for i, s3_keys in sorted(cached_files.items()):
+            for k, s3_key in enumerate(s3_keys):
+                if emit is not None: stream_uploaded_image(emit, job_start_time, image_index, i, variants[i][1]['NOISE_SEED'], s3_key, cached=True, batch_index=InputPreprocessor.image_inputs(variants[i][1], k).get('BATCH_INDEX'), output_options=output_options)
+                image_index += 1
+        result_cache_stats = ResultCache().count(len(cached_files), len(variants) - len(cached_files)) if RESULT_CACHE_ENABLED else None
+        pending = [i for i in range(len(variants)) if i not in cached_files] # Variants that still have to be generated
+        variant_files = {i: [] for i in pending}
+        if pending:
+            pinned_models = InputPreprocessor.models_for_job(comfy_api, template_inputs)
+            ModelCache().pin(pinned_models) # Keep this job's models from being evicted while it runs
+            with trace.stage('staging_wait'):
+                cancel.acquire(STAGING_SLOTS) # Concurrent jobs take turns on disk and network; the slot is freed before sampling starts
+            try:
+                models_start_time = time.time()
+                model_futures = ModelCache().start_models(pinned_models) # Model copies run in the background while the input images are transferred
+                backend = comfy_connector.acquire_backend(pinned_models) # Least loaded ComfyUI process, preferring one that already ran this checkpoint
+                if input_keys:
+                    input_names = backend.upload_from_s3_to_input(aws_connector, input_keys, cancel, trace) # All inputs are transferred concurrently, each under a name unique to its content
+                    node_names = {os.path.basename(s3_key): name for s3_key, name in input_names.items()} # Workflows name their inputs by file name, as ComfyUI used to store them
+                    node_names.update(input_names)
+                    variants = [(template.with_input_images(variant_api, node_names), variant_inputs) for variant_api, variant_inputs in variants]
+                InputPreprocessor.get_models_from_storage(pinned_models, model_futures, cancel) # Wait for the models copied from network storage to ComfyUI
+                trace.add('model_staging', time.time() - models_start_time) # From the start of the copies, which overlap the input transfer, to the last one done
+            finally:
+                STAGING_SLOTS.release()
+            cancel.raise_if_cancelled()
+            output_batch = OutputStage().start_batch(cancel, trace, output_options)
+            on_event = None
+            if emit is not None and payload.get('stream_progress'):
+                def on_event(index, event_type, data):
+                    stream_progress(emit, pending[index], event_type, data)
+            images_per_variant = backend.generate_images_pipelined([variants[i][0] for i in pending], template, on_event, cancel=cancel, trace=trace) # Seeds are queued in ComfyUI ahead of time, up to MAX_QUEUED_PROMPTS across all jobs
+            for i, images in zip(pending, images_per_variant):
+                variant_inputs = variants[i][1]
+                if 'BATCH_SIZE' in variant_inputs and len(images) != variant_inputs['BATCH_SIZE']:
+                    aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, f"Latent batch of {variant_inputs['BATCH_SIZE']} returned {len(images)} images; BATCH_INDEX follows output order", level='WARNING')
+                for k, image in enumerate(images):
+                    image_inputs = InputPreprocessor.image_inputs(variant_inputs, k)
+                    on_uploaded = functools.partial(stream_uploaded_image, emit, job_start_time, image_index, i, variant_inputs['NOISE_SEED'], batch_index=image_inputs.get('BATCH_INDEX'), output_options=output_options) if emit is not None else None
+                    variant_files[i].append(output_batch.submit(image, image_inputs, on_uploaded)) # Encoding and upload run in the background while ComfyUI samples the next seed
+                    image_index += 1
+                print(f"Image {i+1} - Seed: {variant_inputs['NOISE_SEED']}")
+                aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, f"Image {i+1} - Seed: {variant_inputs['NOISE_SEED']}", level='INFO', sampled=True)    
+            output_batch.results() # Raises if any upload failed
+            for i in pending:
+                if cache_keys and variant_files[i]: ResultCache().store(cache_keys[i], variant_files[i])
+        files = [s3_key for i in range(len(variants)) for s3_key in cached_files.get(i, variant_files.get(i, []))] # S3 keys in seed order
+        job_status = 'succeeded'
+        if payload.get('return_stats') or emit is not None: # Opt-in for the aggregated result, so clients expecting a plain list of keys are unaffected; the streaming summary always has them
+            stats = {"s3_keys": files, "stages": trace.as_dict(), "result_cache": None}
+            if output_options.thumbnail_size:
+                stats["thumbnail_keys"] = [thumbnail_filename(s3_key, output_options) for s3_key in files] # Cached results share the naming, so their thumbnails exist too
+            if result_cache_stats is not None:
+                stats["result_cache"] = {"hits": len(cached_files), "misses": len(pending), "worker_hits": result_cache_stats["hits"], "worker_misses": result_cache_stats["misses"]}
+            return stats
+        return files
+    except JobCancelled as e:
+        job_status = 'cancelled'
+        aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, f"Job cancelled after {(time.time()-job_start_time):.2f} seconds: {str(e)}", level='WARNING')
     except Exception as e:
         exc_type, exc_value, exc_traceback = sys.exc_info()
         line_no = exc_traceback.tb_lineno
-        error_message = f'Unhandled error after {(time.time()-START_TIME):.2f} seconds at line {line_no}: {str(e)}'
+        error_message = f'Unhandled error after {(time.time()-job_start_time):.2f} seconds at line {line_no}: {str(e)}'
         print(INSTANCE_IDENTIFIER + " - worker_routine - " + error_message)        
         aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, error_message, level='ERROR')
-        comfy_connector.kill_api()
+        if backend is not None and backend.active_jobs == 1 and not cancel.cancelled: backend.kill_api() # The supervisor restarts it; a backend still serving other jobs is left alone and only restarted if its process dies
+    finally:
+        stages = trace.as_dict()
+        MetricsRegistry().record(stages, job_status)
+        aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, f"Job {job_status}. Stage timings in seconds: {stages}", level='INFO')
+        ModelCache().release_copies(model_futures, abandon=cancel.cancelled) # Copies only this job wanted are stopped and their partial files removed
+        if backend is not None: comfy_connector.release_backend(backend)
+        ModelCache().unpin(pinned_models)
 
-def handler(event):
+def cancel_job(cancel, reason): # Cancelling makes HTTP calls to ComfyUI, so it runs on its own thread rather than on the event loop
+    threading.Thread(target=cancel.cancel, args=(reason,), name='distillery-cancel', daemon=True).start()
+
+async def handler(event):
     aws_connector = AWSConnector()
+    request_start_time = time.time()
     aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, f"Worker was called by Master. event = {event}.", level='INFO')        
-    with ThreadPoolExecutor(max_workers=1) as executor:
-        future = executor.submit(worker_routine, event)
+    cancel = CancelToken()
+    try:
+        # Waiting for the result within WORKER_TIMEOUT seconds, without blocking the event loop that feeds the other jobs
+        result = await asyncio.wait_for(asyncio.get_running_loop().run_in_executor(JOB_POOL, worker_routine, event, None, cancel), timeout=WORKER_TIMEOUT)
+    except asyncio.TimeoutError:
+        # If the timeout occurs, stop the job's work in ComfyUI, S3 and the model cache, log an error and return a timeout response
+        cancel_job(cancel, f"Handler timed out after {WORKER_TIMEOUT} seconds")
+        aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, f"Handler timed out after {WORKER_TIMEOUT} seconds.", level='ERROR')
+        return f"ERROR: Handler timed out after {WORKER_TIMEOUT} seconds."
+    except asyncio.CancelledError: # The job was cancelled through RunPod
+        cancel_job(cancel, "Job cancelled by the client")
+        raise
+    aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, f"Worker finished! Throughput time: {(time.time()-request_start_time):.2f} seconds.", level='INFO')
+    return result
+
+async def stream_handler(event): # Generator handler: yields each image as soon as it is in S3, then a final summary; RunPod also aggregates the yields for /run and /runsync
+    aws_connector = AWSConnector()
+    request_start_time = time.time()
+    aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, f"Worker was called by Master in streaming mode. event = {event}.", level='INFO')
+    loop = asyncio.get_running_loop()
+    updates = asyncio.Queue()
+    cancel = CancelToken()
+    job_done = object() # Sentinel queued after the job's last update
+    def emit(update): # Called from job and upload threads
+        loop.call_soon_threadsafe(updates.put_nowait, update)
+    def run_job():
         try:
-            # Waiting for the result within WORKER_TIMEOUT seconds
-            result = future.result(timeout=WORKER_TIMEOUT)
-        except TimeoutError:
-            # If the timeout occurs, log an error and return a timeout response
-            aws_connector = AWSConnector()
-            aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, f"Handler timed out after {WORKER_TIMEOUT} seconds.", level='ERROR')
-            return f"ERROR: Handler timed out after {WORKER_TIMEOUT} seconds."
-        # Cancel the future to explicitly kill the thread if it's still running
-        future.cancel()
-        aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, f"Worker finished! Throughput time: {(time.time()-START_TIME):.2f} seconds.", level='INFO')
-        return result
-
-runpod.serverless.start({"handler": handler})
\ No newline at end of file
+            return worker_routine(event, emit, cancel)
+        finally:
+            emit(job_done)
+    job = loop.run_in_executor(JOB_POOL, run_job)
+    deadline = request_start_time + WORKER_TIMEOUT
+    finished = False
+    try:
+        while True:
+            try:
+                update = await asyncio.wait_for(updates.get(), timeout=max(deadline - time.time(), 0))
+            except asyncio.TimeoutError:
+                cancel_job(cancel, f"Handler timed out after {WORKER_TIMEOUT} seconds")
+                aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, f"Handler timed out after {WORKER_TIMEOUT} seconds.", level='ERROR')
+                yield {"event": "error", "error": f"Handler timed out after {WORKER_TIMEOUT} seconds."}
+                return
+            if update is job_done:
+                finished = True
+                break
+            yield update
+    finally:
+        if not finished: # The client cancelled the job or stopped reading the stream
+            cancel_job(cancel, "Job cancelled by the client")
+    result = await job
+    if isinstance(result, list):
+        result = {"s3_keys": result}
+    if not isinstance(result, dict): # worker_routine logs its own errors and returns None or an error string
+        yield {"event": "error", "error": result or "Job failed, see the worker logs."}
+        return
+    aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, f"Worker finished! Throughput time: {(time.time()-request_start_time):.2f} seconds.", level='INFO')
+    yield {"event": "done", **result, "elapsed_seconds": round(time.time() - request_start_time, 3)}
+
+def concurrency_modifier(current_concurrency): # RunPod asks this how many jobs the worker may hold at once
+    return WORKER_CONCURRENCY
+
+if __name__ == "__main__": # Importing the module (e.g. from the benchmarks) must not start the RunPod loop
+    MetricsRegistry() # Starts the EMF flush thread and the /metrics endpoint before the first job
+    if STREAM_RESULTS:
+        runpod.serverless.start({"handler": stream_handler, "concurrency_modifier": concurrency_modifier, "return_aggregate_stream": True})
+    else:
+        runpod.serverless.start({"handler": handler, "concurrency_modifier": concurrency_modifier})